@@ -3,21 +3,28 @@
 
 '''Web App'''
 
-import logging; logging.basicConfig(level=logging.INFO)
+import logging
 
-import asyncio, os, json, time
+import asyncio, os, time, mimetypes
 
 from datetime import datetime
 
 from aiohttp import web
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from markupsafe import Markup
 
 from config import configs
 
-import orm
+#在导入其他模块前初始化日志，模块加载时的日志也经过队列输出
+import logconf; logconf.setup(configs.logging)
+
+import orm, serializer, compress, metrics, render
+
+from fragment_cache import FragmentCacheExtension, fragments
 
-from coroweb import add_routes, add_static
+from coroweb import add_routes, add_static, conditional_response, validator_headers
 
 from handlers import cookie2user, COOKIE_NAME
 
@@ -38,40 +45,192 @@ def init_jinja2(app, **kw):
         #使用模板时检查模板文件的状态，若有修改，则重新加载模板，默认为开启
         auto_reload = kw.get('auto_reload', True)
     )
+    #生产模式下模板不会修改，关闭文件状态检查，并将编译结果缓存到磁盘，多个进程和重启后都可复用
+    production = kw.get('production', False)
+    if production:
+        options['auto_reload'] = False
+        bytecode_cache = kw.get('bytecode_cache', None)
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-    logging.info('set jinja2 template path: %s' % path)
+    logging.info('set jinja2 template path: %s', path)
     #创建模板环境
     #FileSystemLoader(), 从提供的路径中加载模板
-    env = Environment(loader=FileSystemLoader(path), **options)
+    env = Environment(loader=FileSystemLoader(path), extensions=[FragmentCacheExtension], **options)
     #获取传入的过滤器，变量可以在模板中被过滤器修改
     filters = kw.get('filters', None)
     if filters is not None:
         for name, f in filters.items():
             #将传入的过滤器添加到模板的过滤器中
             env.filters[name] = f
+    if production:
+        preload_templates(env)
     #将模板环境作为属性添加到app中
     app['__templating__'] = env
 
+#启动时编译并加载全部模板，避免第一次请求时才编译，并记录冷启动耗时
+def preload_templates(env):
+    start = time.time()
+    names = env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        env.get_template(name)
+    logging.info('preload %s templates in %.1f ms', len(names), (time.time() - start) * 1000)
+
 #以下三个函数为middleware，是一种拦截器
 #在一个URL被某个函数处理前后，可经过middleware改变输入输出
 
-#此函数的作用是在处理URL请求前，将请求方法和路径记录下来
+#访问日志，每个请求处理完后输出一行，格式为key=value
+access_logger = logging.getLogger('access')
+
+#此函数的作用是在处理URL请求后，将请求方法、路径、状态码、耗时等记录下来
 @asyncio.coroutine
 def logger_factory(app, handler):
     @asyncio.coroutine
     def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        return (yield from handler(request))
+        start = time.time()
+        status = 500
+        try:
+            resp = yield from handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            if access_logger.isEnabledFor(logging.INFO):
+                user = getattr(request, '__user__', None)
+                uow = getattr(request, '__unit_of_work__', None)
+                access_logger.info('method=%s path=%s status=%s ms=%.1f queries=%s user=%s',
+                    request.method, request.raw_path, status, (time.time() - start) * 1000,
+                    uow.queries if uow is not None else '-', user.id if user else '-')
     return logger
 
+#压缩响应：静态文件优先返回预先生成的.br/.gz文件，其余响应按大小和类型在线压缩
+@asyncio.coroutine
+def compress_factory(app, handler):
+    options = configs.compress
+    @asyncio.coroutine
+    def compress_response(request):
+        encodings = compress.accepted_encodings(request.headers.get('Accept-Encoding'), options.brotli)
+        if not encodings:
+            return (yield from handler(request))
+        prefix, root = app.get('__static__', (None, None))
+        if prefix and request.path.startswith(prefix):
+            filename = os.path.normpath(os.path.join(root, request.path[len(prefix):]))
+            #防止通过../访问静态文件目录以外的文件
+            found = filename.startswith(root + os.sep) and compress.find_precompressed(filename, encodings)
+            if found:
+                encoding, path = found
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                return web.FileResponse(path, headers={
+                    'Content-Type': content_type,
+                    'Content-Encoding': encoding,
+                    'Vary': 'Accept-Encoding'
+                })
+            return (yield from handler(request))
+        resp = yield from handler(request)
+        if isinstance(resp, web.StreamResponse) and resp.status == 304:
+            _not_modified_encoding(request, resp, encodings)
+            return resp
+        if not isinstance(resp, web.Response) or not isinstance(resp.body, bytes) or resp.status < 200 or resp.status == 204:
+            return resp
+        if 'Content-Encoding' in resp.headers or not compress.compressible(resp.content_type, len(resp.body), options.min_size):
+            return resp
+        encoding = encodings[0]
+        body = resp.body
+        #较大的消息主体在线程池中压缩，避免阻塞事件循环
+        if len(body) >= options.executor_size:
+            body = yield from asyncio.get_event_loop().run_in_executor(None, compress.compress, body, encoding, options.level, options.quality)
+        else:
+            body = compress.compress(body, encoding, options.level, options.quality)
+        resp.body = body
+        resp.headers['Content-Encoding'] = encoding
+        _mark_encoded(resp, encoding)
+        return resp
+    return compress_response
+
+#压缩后的表示与原内容不同，强ETag需加上压缩方式后缀
+def _mark_encoded(resp, encoding):
+    etag = resp.headers.get('ETag')
+    if etag and etag.endswith('"') and not etag.startswith('W/'):
+        resp.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+    _add_vary(resp, 'Accept-Encoding')
+
+def _add_vary(resp, header):
+    vary = resp.headers.get('Vary')
+    resp.headers['Vary'] = vary + ', ' + header if vary else header
+
+#304响应没有消息主体，ETag应与客户端缓存的表示一致：客户端缓存的是压缩后的表示时，If-None-Match中带有压缩方式后缀
+def _not_modified_encoding(request, resp, encodings):
+    etag = resp.headers.get('ETag')
+    if etag and etag.endswith('"') and not etag.startswith('W/'):
+        tags = [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]
+        for encoding in encodings:
+            suffixed = '%s-%s"' % (etag[:-1], encoding)
+            if suffixed in tags or 'W/' + suffixed in tags:
+                resp.headers['ETag'] = suffixed
+                break
+    _add_vary(resp, 'Accept-Encoding')
+
+#作为指标标签的请求方法
+_METRIC_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'))
+
+#记录每个请求的耗时、状态码和执行的SQL语句数，放在最外层
+@asyncio.coroutine
+def metrics_factory(app, handler):
+    @asyncio.coroutine
+    def record_metrics(request):
+        #静态文件和未匹配的路径统一记为other
+        route = getattr(request.match_info.handler, '__route__', None) or 'other'
+        #请求方法由客户端任意指定，非标准的方法统一记为other，以免标签值无限增长
+        method = request.method if request.method in _METRIC_METHODS else 'other'
+        start = time.time()
+        status = 500
+        metrics.REQUESTS_IN_PROGRESS.inc()
+        try:
+            resp = yield from handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.REQUESTS_IN_PROGRESS.dec()
+            metrics.REQUEST_LATENCY.observe(time.time() - start, (route, method))
+            metrics.REQUEST_TOTAL.inc((route, method, status))
+            uow = getattr(request, '__unit_of_work__', None)
+            if uow is not None:
+                metrics.REQUEST_QUERIES.observe(uow.queries, (route,))
+    return record_metrics
+
+#以Prometheus文本格式输出指标
+@asyncio.coroutine
+def metrics_handler(request):
+    resp = web.Response(body=metrics.REGISTRY.exposition().encode('utf-8'))
+    resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
+#为每个请求创建一个工作单元，请求内Model.find()按主键复用已加载的实例，请求结束后丢弃
+@asyncio.coroutine
+def unit_of_work_factory(app, handler):
+    @asyncio.coroutine
+    def unit_of_work(request):
+        request.__unit_of_work__ = orm.begin_unit_of_work()
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.end_unit_of_work()
+    return unit_of_work
+
 #在处理URL请求前，解析出用户信息并绑定到request中
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
+        logging.debug('check user: %s %s', request.method, request.path)
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         #若存在cookie，解析用户信息
@@ -79,7 +238,7 @@ def auth_factory(app, handler):
             user = yield from cookie2user(cookie_str)
             #若有用户信息，将其息绑定到request中，没有则表明cookie是伪造的
             if user:
-                logging.info('set current user: %s' % user.email)
+                logging.debug('set current user: %s', user.email)
                 request.__user__ = user
         #若请求路径是管理页面，但用户信息不存在或拥有管理员权限，则无法操作，跳转到登录页面
         if request.path.startswith('/manage/') and (request.__user__ is None or request.__user__.admin):
@@ -95,23 +254,108 @@ def data_factory(app, handler):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = yield from request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                logging.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = yield from request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                logging.debug('request form: %s', request.__data__)
         return (yield from handler(request))
     return parse_data
 
+#以分块传输的方式边渲染边发送页面，模板的<head>部分渲染完立即发送，之后每积累buffer_size个字符发送一次
+#浏览器可以提前加载css和js，服务器也不必在内存中保存整个页面
+@asyncio.coroutine
+def stream_template(request, template, r, buffer_size):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    #URL处理函数通过check_not_modified()记录了验证器时，一并发送
+    validators = getattr(request, '__validators__', None)
+    if validators:
+        resp.headers.update(validator_headers(*validators))
+    resp.enable_chunked_encoding()
+    #aiohttp边发送边压缩，指定用gzip，ETag的后缀与压缩middleware一致
+    if configs.compress.enabled and 'gzip' in compress.accepted_encodings(request.headers.get('Accept-Encoding'), False):
+        resp.enable_compression(web.ContentCoding.gzip)
+        _mark_encoded(resp, 'gzip')
+    yield from resp.prepare(request)
+    start = time.time()
+    buf, size, head_sent = [], 0, False
+    for chunk in template.generate(**r):
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size or (not head_sent and '</head>' in chunk):
+            head_sent = head_sent or '</head>' in chunk
+            yield from resp.write(''.join(buf).encode('utf-8'))
+            buf, size = [], 0
+    if buf:
+        yield from resp.write(''.join(buf).encode('utf-8'))
+    yield from resp.write_eof()
+    elapsed = time.time() - start
+    metrics.RENDER_TIME.observe(elapsed, (template.name,))
+    logging.debug('stream %s in %.1f ms', template.name, elapsed * 1000)
+    return resp
+
+#同时进行的流式导出数，在init()中按配置创建
+_json_streams = None
+
+#以分块传输的方式逐批发送大量的JSON结果，每从数据库读到一批就编码发送一批，内存占用与结果总数无关
+#每个导出在发送完之前一直占用一个数据库连接，因此限制同时进行的导出数，并限制读取一批和发送一块的时间
+@asyncio.coroutine
+def stream_json(request, r):
+    if _json_streams.locked():
+        r.source.close()
+        raise web.HTTPServiceUnavailable(text='too many streams, try again later')
+    yield from _json_streams.acquire()
+    try:
+        return (yield from _stream_json(request, r, configs.json.stream_timeout))
+    finally:
+        _json_streams.release()
+
+@asyncio.coroutine
+def _stream_json(request, r, timeout):
+    resp = web.StreamResponse()
+    resp.content_type = r.content_type
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    #aiohttp边发送边压缩，指定用gzip，ETag的后缀与压缩middleware一致
+    if configs.compress.enabled and 'gzip' in compress.accepted_encodings(request.headers.get('Accept-Encoding'), False):
+        resp.enable_compression(web.ContentCoding.gzip)
+        _mark_encoded(resp, 'gzip')
+    yield from resp.prepare(request)
+    start, count = time.time(), 0
+    try:
+        yield from asyncio.wait_for(resp.write(r.head), timeout)
+        while True:
+            batch = yield from asyncio.wait_for(r.source.fetch(), timeout)
+            if not batch:
+                break
+            #客户端接收过慢时写入会一直等待，超时后放弃
+            yield from asyncio.wait_for(resp.write(r.encode(batch, count == 0)), timeout)
+            count += len(batch)
+        yield from asyncio.wait_for(resp.write(r.tail), timeout)
+    except asyncio.TimeoutError:
+        logging.warning('stream json timeout after %s objects, %ss without progress', count, timeout)
+        raise
+    finally:
+        #客户端中途断开时也要归还数据库连接
+        r.source.close()
+    yield from resp.write_eof()
+    logging.debug('stream %s json objects in %.1f ms', count, (time.time() - start) * 1000)
+    return resp
+
 #在处理完URL请求后，将响应结果转换成web.Response对象返回
 @asyncio.coroutine
 def response_factory(app, handler):
     @asyncio.coroutine
     def response(request):
-        logging.info('Response handler...')
+        logging.debug('Response handler...')
         r = yield from handler(request)
         #StreamResponse是aiohttp的HTTP响应基类，web.Response继承于此，因此直接返回
         if isinstance(r, web.StreamResponse):
             return r
+        #流式JSON，逐批发送
+        if isinstance(r, serializer.JSONStream):
+            return (yield from stream_json(request, r))
         #若响应结果为字节流，将其作为响应的body部分返回，并将消息主体类型设置为流类型
         if isinstance(r, bytes):
             resp = web.Response(body=r)
@@ -126,21 +370,30 @@ def response_factory(app, handler):
             #否则，将字符串编码后作为body部分返回
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
-            return resp
+            return conditional_response(request, resp)
         #若响应结果为字典，获取其模板属性
         if isinstance(r, dict):
             template = r.get('__template__')
             #若无模板属性，将字典转化为JSON格式返回
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=serializer.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
-                return resp
+                return conditional_response(request, resp)
             #有模板，调用并用响应字典进行渲染
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                #URL处理函数返回'__stream__': True时，以流的方式渲染，适合内容很长的页面
+                if r.get('__stream__') and request.method == 'GET':
+                    return (yield from stream_template(request, app['__templating__'].get_template(template), r, configs.templates.stream_buffer))
+                start = time.time()
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                elapsed = time.time() - start
+                metrics.RENDER_TIME.observe(elapsed, (template,))
+                logging.debug('render %s in %.1f ms', template, elapsed * 1000)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
-                return resp
+                #添加ETag和Last-Modified，客户端缓存有效时返回304
+                return conditional_response(request, resp)
         #若响应结果为整型，则为状态码，如404, 500等
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
@@ -171,27 +424,49 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)    
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
+#将对象序列化为JSON内嵌在<script>中，如服务端预先查询好的首页数据
+def json_filter(obj):
+    return Markup(serializer.dumps_html(obj))
+
 @asyncio.coroutine
 def init(loop):
+    global _json_streams
     yield from orm.create_pool(loop=loop, **configs.db)
+    _json_streams = asyncio.Semaphore(configs.json.max_streams)
+    #选择JSON序列化后端
+    serializer.use(configs.json.backend)
     #创建Web App，循环类型为消息循环传入拦截器
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
-    ])
+    middlewares = [logger_factory, unit_of_work_factory, auth_factory, response_factory]
+    #压缩放在最外层之后，对最终的响应进行处理
+    if configs.compress.enabled:
+        middlewares.insert(1, compress_factory)
+    #指标统计放在最外层，耗时包含其他所有middleware
+    if configs.metrics.enabled:
+        middlewares.insert(0, metrics_factory)
+    app = web.Application(loop=loop, middlewares=middlewares)
+    #Markdown渲染服务的进程池配置
+    render.configure(**configs.render)
+    #模板片段缓存的容量和默认缓存时间
+    fragments.maxsize = configs.fragment_cache.maxsize
+    fragments.ttl = configs.fragment_cache.ttl
     #初始化jinja2模板
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter, json=json_filter), **configs.templates)
     #注册URL处理函数
     add_routes(app, 'handlers')
     #添加静态文件
     add_static(app)
+    if configs.metrics.enabled:
+        app.router.add_route('GET', configs.metrics.path, metrics_handler)
     #创建TCP服务器
     srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)         #创建TCP服务
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
-#获取Eventloop
-loop = asyncio.get_event_loop()   
-#run_until_complete(future)，运行直到future完成,即接收到返回值后就退出
-loop.run_until_complete(init(loop))
-#run_forever()，运行直到stop()被调用
-loop.run_forever()
+#渲染服务的子进程会重新导入主模块，只在直接运行时启动服务器
+if __name__ == '__main__':
+    #获取Eventloop
+    loop = asyncio.get_event_loop()   
+    #run_until_complete(future)，运行直到future完成,即接收到返回值后就退出
+    loop.run_until_complete(init(loop))
+    #run_forever()，运行直到stop()被调用
+    loop.run_forever()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Markdown转换的耗时：每次新建Markdown对象、复用MarkdownPool中的对象、tokenizer引擎、修改一处后按块增量渲染、markdown_many批量转换
+用法：python3 bench_markdown.py [段落数...]'''
+
+import os, sys, timeit
+
+import markdown2
+
+#生成一篇包含标题、列表、代码、链接和强调的博客，paragraphs为段落数
+def make_doc(paragraphs):
+    parts = ['# 测试博客\n']
+    for i in range(paragraphs):
+        parts.append('## 第%s节\n' % i)
+        parts.append('这是一段用来测试 *Markdown* 转换性能的**文字**，包含`行内代码`和[链接](http://example.com/%s "标题")。\n' % i)
+        parts.append('- 列表项一\n- 列表项二 with _emphasis_\n- 列表项三\n')
+        parts.append('    def f(x):\n        return x * %s\n' % i)
+        parts.append('> 引用的内容 & <b>html</b>\n')
+    return '\n'.join(parts)
+
+def bench(name, fn, number):
+    t = timeit.timeit(fn, number=number)
+    print('%-28s %10.1f us/op' % (name, t / number * 1e6))
+
+def main(sizes):
+    bench('Markdown() setup only', lambda: markdown2.Markdown(), 20000)
+    for n in sizes:
+        text = make_doc(n)
+        number = max(20, 2000 // n)
+        #两种方式的输出应当一致
+        assert markdown2.Markdown().convert(text) == markdown2.markdown(text)
+        bench('new Markdown()[%s]' % n, lambda: markdown2.Markdown().convert(text), number)
+        bench('markdown() pooled[%s]' % n, lambda: markdown2.markdown(text), number)
+        #tokenizer引擎的输出与regex引擎相同
+        assert markdown2.markdown(text, engine='tokenizer') == markdown2.markdown(text)
+        bench('markdown() tokenizer[%s]' % n, lambda: markdown2.markdown(text, engine='tokenizer'), number)
+        #每次修改第一节中的一个字，其余的块命中缓存
+        blocks = markdown2.BlockCache()
+        edits = [text.replace('第0节', '第0节%s' % i, 1) for i in range(number)]
+        assert markdown2.markdown(edits[0], block_cache=blocks) == markdown2.markdown(edits[0])
+        it = iter(edits)
+        bench('markdown() incremental[%s]' % n, lambda: markdown2.markdown(next(it), block_cache=blocks), number)
+    #批量转换200篇10节的博客，单进程和每个CPU核一个进程，耗时为整批的时间
+    texts = [make_doc(10).replace('第0节', '第0节%s' % i, 1) for i in range(200)]
+    assert list(markdown2.markdown_many(texts)) == list(markdown2.markdown_many(texts, processes=None))
+    bench('markdown_many()[200] 1 proc', lambda: list(markdown2.markdown_many(texts)), 3)
+    bench('markdown_many()[200] %s procs' % os.cpu_count(), lambda: list(markdown2.markdown_many(texts, processes=None)), 3)
+    bench('markdown_many()[200] tokenizer', lambda: list(markdown2.markdown_many(texts, engine='tokenizer')), 3)
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1, 10, 100])
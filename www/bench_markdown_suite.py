@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Markdown渲染的基准测试：按文档类型和extras分别统计Markdown.convert的耗时与内存峰值
+
+语料由固定的随机种子生成，每次运行内容相同：短博客、长博客、代码为主、表格、多层嵌套列表、大量链接
+结果可保存为基准文件，之后的运行与之比较，耗时或内存超出阈值、输出的html发生变化时标记出来并返回非0
+用法：
+    python3 bench_markdown_suite.py --save baseline.json     修改前保存基准
+    python3 bench_markdown_suite.py --compare baseline.json  修改后比较
+    python3 bench_markdown_suite.py --classes long,code --extras none,all
+    python3 bench_markdown_suite.py --engine tokenizer --compare baseline.json  与regex引擎的基准比较，输出应当相同
+    python3 bench_markdown_suite.py --pathological              已知的最坏情况输入，检查耗时是否线性增长'''
+
+import sys, json, time, random, hashlib, argparse, platform, tracemalloc
+
+import markdown2
+
+WORDS = ['博客', '性能', 'markdown', 'python', 'regex', '缓存', 'render', 'html', '测试', 'server', '数据库', 'async']
+
+def _sentence(r, n=12):
+    words = []
+    for _ in range(n):
+        w = r.choice(WORDS)
+        k = r.random()
+        if k < 0.08:
+            w = '*%s*' % w
+        elif k < 0.14:
+            w = '**%s**' % w
+        elif k < 0.18:
+            w = '`%s()`' % w
+        elif k < 0.22:
+            w = '[%s](http://example.com/%s "%s")' % (w, r.randint(0, 999), w)
+        words.append(w)
+    return ' '.join(words) + '。'
+
+def _paragraph(r, sentences=4):
+    return ' '.join(_sentence(r) for _ in range(sentences))
+
+def _code(r, lines=8):
+    return '\n'.join('def f%s(x):\n    return x * %s  # <%s> & "%s"' % (i, i, r.choice(WORDS), r.choice(WORDS)) for i in range(lines // 2))
+
+#短博客：几段文字，少量标题、列表和引用
+def short_post(r):
+    parts = ['# 短博客', _paragraph(r), '## 小结', _paragraph(r, 2), '- 要点一\n- 要点二\n- 要点三', '> ' + _sentence(r), _paragraph(r, 3)]
+    return '\n\n'.join(parts)
+
+#长博客：上百个小节，各种块混合
+def long_post(r, sections=120):
+    parts = ['# 长博客']
+    for i in range(sections):
+        parts.append('## 第%s节' % i)
+        parts.append(_paragraph(r))
+        k = i % 4
+        if k == 0:
+            parts.append('\n'.join('- ' + _sentence(r, 6) for _ in range(4)))
+        elif k == 1:
+            parts.append('\n'.join('    ' + l for l in _code(r, 4).split('\n')))
+        elif k == 2:
+            parts.append('> ' + _sentence(r) + '\n> ' + _sentence(r))
+        else:
+            parts.append('1. %s\n2. %s' % (_sentence(r, 5), _sentence(r, 5)))
+    return '\n\n'.join(parts)
+
+#代码为主：围栏代码块、缩进代码块和行内代码
+def code_post(r, blocks=40):
+    parts = ['# 代码']
+    for i in range(blocks):
+        parts.append('第%s段，调用`f%s(x)`和`g(%s)`：' % (i, i, i))
+        if i % 2:
+            parts.append('```python\n%s\n```' % _code(r, 12))
+        else:
+            parts.append('\n'.join('    ' + l for l in _code(r, 12).split('\n')))
+    return '\n\n'.join(parts)
+
+#表格：tables extra的格式，未开启时作为普通段落渲染
+def table_post(r, tables=20, rows=15):
+    parts = ['# 表格']
+    for i in range(tables):
+        lines = ['| 名称 | 数量 | 说明 |', '|:-----|-----:|:----:|']
+        for j in range(rows):
+            lines.append('| %s | %s | %s |' % (r.choice(WORDS), r.randint(0, 10000), _sentence(r, 3)))
+        parts.append('\n'.join(lines))
+        parts.append(_paragraph(r, 1))
+    return '\n\n'.join(parts)
+
+#多层嵌套列表
+def nested_lists(r, items=12, depth=6):
+    def level(d):
+        lines = []
+        indent = '    ' * d
+        for i in range(items // (d + 1) + 1):
+            lines.append('%s%s %s' % (indent, '-' if d % 2 else '1.', _sentence(r, 6)))
+            if d < depth and i == 0:
+                lines.extend(level(d + 1))
+        return lines
+    return '# 嵌套列表\n\n' + '\n\n'.join('\n'.join(level(0)) for _ in range(8))
+
+#大量链接：行内链接、引用链接、自动链接、图片和脚注
+def link_post(r, paragraphs=60):
+    parts = ['# 链接']
+    refs = []
+    for i in range(paragraphs):
+        refs.append('[ref%s]: http://example.com/ref/%s "引用%s"' % (i, i, i))
+        parts.append('%s 见[引用%s][ref%s]、<http://example.com/auto/%s>、![图片%s](/static/img/%s.png)和脚注[^n%s]。'
+                     % (_sentence(r, 8), i, i, i, i, i, i))
+        parts.append('[^n%s]: 第%s个脚注，%s' % (i, i, _sentence(r, 4)))
+    return '\n\n'.join(parts + refs)
+
+CLASSES = [
+    ('short', short_post),
+    ('long', long_post),
+    ('code', code_post),
+    ('tables', table_post),
+    ('nested', nested_lists),
+    ('links', link_post),
+]
+
+EXTRAS = [
+    ('none', None),
+    ('fenced-code-blocks', ['fenced-code-blocks']),
+    ('tables', ['tables']),
+    ('toc', ['toc']),
+    ('footnotes', ['footnotes']),
+    ('code-friendly', ['code-friendly']),
+    ('all', ['fenced-code-blocks', 'tables', 'toc', 'footnotes', 'code-friendly', 'nofollow']),
+]
+
+#已知的最坏情况输入，n为重复的次数，渲染耗时应随n线性增长
+#每项都曾使某个正则表达式或扫描退化为平方复杂度：未闭合的链接、图片、html块、强调、自动链接，不同类型交替的列表，标题中的长串#
+PATHOLOGICAL = [
+    ('open_brackets', lambda n: '[' * n),
+    ('link_opens', lambda n: '[a](' * n),
+    ('image_opens', lambda n: '![a](b ' * n),
+    ('link_titles', lambda n: '[a](b' + ' "x' * n + ')'),
+    ('nested_brackets', lambda n: '[' * n + 'a' + ']' * n + '.'),
+    ('ref_links', lambda n: '[a][' * n),
+    ('html_blocks', lambda n: '<div>\n\n' * n),
+    ('html_lines', lambda n: '<div>\n' * n),
+    ('autolinks', lambda n: '<http://a ' * n),
+    ('emphasis', lambda n: '**a *b ' * n),
+    ('underscores', lambda n: '*a ' * n + ' c_d_'),
+    ('lists', lambda n: 'x\n\n- a\n\n' * n + '1. x\n'),
+    ('nested_lists', lambda n: ''.join('  ' * (i % 40) + '- a\n' for i in range(n))),
+    ('header_hashes', lambda n: '# ' + '#' * n + ' a\n'),
+    ('blockquotes', lambda n: '>' * n + ' a'),
+]
+
+#可选的渲染引擎，tokenizer不支持的文档由regex渲染，结果中的engine为实际使用的引擎
+ENGINES = {'regex': markdown2.Markdown, 'tokenizer': markdown2.TokenizerMarkdown}
+
+def _engine_used(md):
+    return getattr(md, 'engine', None) or 'regex'
+
+def corpus(seed=2016):
+    return [(name, fn(random.Random('%s:%s' % (seed, name)))) for name, fn in CLASSES]
+
+#每轮至少运行min_time秒，取repeat轮中最快的一轮，返回(耗时, html, 实际使用的引擎)
+def time_convert(text, extras, min_time, repeat, engine='regex'):
+    md = ENGINES[engine](extras=extras)
+    start = time.perf_counter()
+    html = md.convert(text)
+    elapsed = time.perf_counter() - start
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    best = elapsed
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            md.convert(text)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best, html, _engine_used(md)
+
+#单次转换分配的内存峰值
+def peak_memory(text, extras, engine='regex'):
+    md = ENGINES[engine](extras=extras)
+    tracemalloc.start()
+    try:
+        md.convert(text)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(classes=None, extras=None, min_time=0.2, repeat=3, engine='regex'):
+    results = {}
+    for cname, text in corpus():
+        if classes and cname not in classes:
+            continue
+        for ename, ex in EXTRAS:
+            if extras and ename not in extras:
+                continue
+            case = '%s/%s' % (cname, ename)
+            #某项出错时记录下来，继续测试其余各项
+            try:
+                seconds, html, used = time_convert(text, ex, min_time, repeat, engine)
+                peak = peak_memory(text, ex, engine)
+            except Exception as e:
+                results[case] = dict(error='%s: %s' % (type(e).__name__, e))
+                print('%-28s %8d chars error: %s' % (case, len(text), results[case]['error']))
+                continue
+            results[case] = dict(seconds=seconds, ops=1.0 / seconds, peak=peak, chars=len(text), engine=used, sha1=hashlib.sha1(html.encode('utf-8')).hexdigest())
+            print('%-28s %8d chars %10.2f ops/s %10.1f ms/op %10.1f KB peak  %s' % (case, len(text), 1.0 / seconds, seconds * 1e3, peak / 1024.0, used))
+            sys.stdout.flush()
+    return results
+
+#与基准比较，返回回退的项数，耗时或内存增加超过threshold(比例)为回退，输出的html不同或出错时也算作回退
+def compare(results, baseline, threshold):
+    regressions = 0
+    print('\n%-28s %10s %10s %8s %8s' % ('case', 'base ms', 'ms', 'time', 'memory'))
+    for case, r in sorted(results.items()):
+        b = baseline.get(case)
+        if b is None:
+            print('%-28s %10s' % (case, 'new'))
+            continue
+        if 'error' in r or 'error' in b:
+            if 'error' in r and 'error' not in b:
+                regressions += 1
+                print('%-28s %10s %s' % (case, 'FAILED', r['error']))
+            elif 'error' not in r:
+                print('%-28s %10s' % (case, 'fixed'))
+            continue
+        dt = r['seconds'] / b['seconds'] - 1
+        dm = r['peak'] / float(max(b['peak'], 1)) - 1
+        flags = []
+        if dt > threshold:
+            flags.append('SLOWER')
+        if dm > threshold:
+            flags.append('MORE MEMORY')
+        if r['sha1'] != b['sha1']:
+            flags.append('OUTPUT CHANGED')
+        if flags:
+            regressions += 1
+        print('%-28s %10.1f %10.1f %+7.1f%% %+7.1f%% %s' % (case, b['seconds'] * 1e3, r['seconds'] * 1e3, dt * 100, dm * 100, ' '.join(flags)))
+    return regressions
+
+#每项分别以n和4n的规模渲染，取repeat次中最快的一次，耗时之比超过max_ratio(线性增长时约为4)时标记为SUPERLINEAR
+#返回标记的项数，嵌套过深等原因退回为纯文本时标记为fallback，不算作失败
+def run_pathological(n=1000, repeat=3, max_ratio=8.0, engine='regex'):
+    failures = 0
+    print('%-20s %10s %10s %8s' % ('case', 'n ms', '4n ms', 'ratio'))
+    for name, fn in PATHOLOGICAL:
+        times = []
+        for size in (n, 4 * n):
+            text = fn(size)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                html = ENGINES[engine]().convert(text)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        ratio = times[1] / max(times[0], 1e-6)
+        flags = []
+        if ratio > max_ratio:
+            flags.append('SUPERLINEAR')
+            failures += 1
+        if html.fallback:
+            flags.append('fallback')
+        print('%-20s %10.1f %10.1f %8.1f %s' % (name, times[0] * 1e3, times[1] * 1e3, ratio, ' '.join(flags)))
+        sys.stdout.flush()
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark markdown2 on a generated corpus.')
+    parser.add_argument('--classes', help='comma separated document classes: %s' % ','.join(n for n, _ in CLASSES))
+    parser.add_argument('--extras', help='comma separated extras sets: %s' % ','.join(n for n, _ in EXTRAS))
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing round')
+    parser.add_argument('--repeat', type=int, default=3, help='timing rounds, the fastest is reported')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    parser.add_argument('--pathological', action='store_true', help='time the known worst-case inputs at n and 4n instead')
+    parser.add_argument('--size', type=int, default=1000, help='n for --pathological')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='regex', help='markdown2 engine to benchmark')
+    args = parser.parse_args(argv)
+    if args.pathological:
+        return 1 if run_pathological(args.size, args.repeat, engine=args.engine) else 0
+    split = lambda s: set(s.split(',')) if s else None
+    results = run(split(args.classes), split(args.extras), args.min_time, args.repeat, args.engine)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(markdown2=markdown2.__version__, python=platform.python_version(), engine=args.engine, results=results), f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''比较API响应的JSON序列化耗时：原来的json.dumps(default=__dict__)与serializer的各个后端
+用法：python3 bench_serializer.py [每页条数...]'''
+
+import sys, time, json, timeit
+
+import serializer
+
+from apis import Page
+
+from models import User, Blog, Comment, next_id
+
+def make_blogs(n):
+    content = '这是一篇用来测试序列化性能的博客。Markdown **content** with `code`.\n\n' * 40
+    return [Blog(id=next_id(), user_id=next_id(), user_name='管理员', user_image='about:blank', name='博客标题 %s' % i, summary='摘要' * 20, content=content, comment_count=i, created_at=time.time()) for i in range(n)]
+
+def make_comments(n):
+    content = '评论内容 <b>escaped</b> & more\n' * 3
+    return [Comment(id=next_id(), blog_id=next_id(), user_id=next_id(), user_name='读者%s' % i, user_image='about:blank', content=content, html_content='<p>%s</p>' % content, created_at=time.time()) for i in range(n)]
+
+def make_users(n):
+    return [User(id=next_id(), email='user%s@example.com' % i, passwd='0' * 40, admin=False, name='用户%s' % i, image='about:blank', created_at=time.time()) for i in range(n)]
+
+#原来response_factory中的序列化方式
+def legacy_dumps(r):
+    return json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+def bench(name, payload, number):
+    results = [('legacy', legacy_dumps)]
+    for backend in sorted(serializer._backends):
+        results.append((backend, serializer._backends[backend]))
+    for label, dumps in results:
+        t = timeit.timeit(lambda: dumps(payload), number=number)
+        print('%-22s %-8s %10.1f us/op %8d bytes' % (name, label, t / number * 1e6, len(dumps(payload))))
+
+def main(sizes):
+    for n in sizes:
+        number = max(10, 20000 // n)
+        bench('api_blogs[%s]' % n, dict(page=Page(n * 10, 1, n), blogs=make_blogs(n)), number)
+        bench('api_comments[%s]' % n, dict(page=Page(n * 10, 1, n), comments=make_comments(n)), number)
+        bench('api_users[%s]' % n, dict(page=Page(n * 10, 1, n), users=make_users(n)), number)
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [10, 100, 1000])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''响应压缩，支持gzip，安装了brotli模块时还支持br
+
+python3 compress.py [静态文件目录]
+为静态文件预先生成.gz和.br压缩文件，客户端支持时直接返回压缩文件'''
+
+import os, sys, zlib, logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#可压缩的消息主体类型，图片、字体等已压缩过的类型不在其中
+COMPRESSIBLE_TYPES = frozenset([
+    'text/html', 'text/plain', 'text/css', 'text/javascript', 'text/xml',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'
+])
+
+#预压缩的静态文件扩展名
+STATIC_EXTENSIONS = ('.html', '.css', '.js', '.json', '.map', '.svg', '.txt', '.xml')
+
+#压缩后文件的扩展名
+SUFFIXES = {
+    'br': '.br',
+    'gzip': '.gz'
+}
+
+#当前支持的压缩方式，按优先级排列
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+#解析请求头Accept-Encoding，返回客户端接受的压缩方式，按服务器的优先级排列
+def accepted_encodings(accept_encoding, allow_brotli=True):
+    '''
+    >>> accepted_encodings('gzip, deflate', False)
+    ['gzip']
+    >>> accepted_encodings('gzip;q=0, identity', False)
+    []
+    >>> accepted_encodings('', False)
+    []
+    '''
+    if not accept_encoding:
+        return []
+    accepted = set()
+    for item in accept_encoding.lower().split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.strip().partition('=')
+            if k == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    return [e for e in available_encodings() if (e in accepted or '*' in accepted) and (allow_brotli or e != 'br')]
+
+#判断响应是否值得压缩
+def compressible(content_type, size, min_size):
+    if size < min_size or not content_type:
+        return False
+    return content_type.split(';', 1)[0].strip().lower() in COMPRESSIBLE_TYPES
+
+#压缩消息主体，level为gzip的压缩级别，quality为brotli的压缩质量
+def compress(body, encoding, level=6, quality=4):
+    if encoding == 'gzip':
+        #wbits=31表示输出gzip格式，且不写入时间戳，相同内容压缩结果相同
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return c.compress(body) + c.flush()
+    if encoding == 'br':
+        return brotli.compress(body, quality=quality)
+    raise ValueError('Unsupported encoding: %s' % encoding)
+
+#查找客户端可接受的预压缩静态文件，返回(压缩方式, 文件路径)，找不到时返回None
+def find_precompressed(filename, encodings):
+    for encoding in encodings:
+        path = filename + SUFFIXES[encoding]
+        if os.path.isfile(path):
+            return encoding, path
+    return None
+
+#为目录下的静态文件生成.gz和.br文件，源文件未修改时跳过，压缩后不变小的文件不生成
+def compress_static(root):
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+            src = os.path.join(dirpath, name)
+            mtime = os.path.getmtime(src)
+            data = None
+            for encoding in available_encodings():
+                dst = src + SUFFIXES[encoding]
+                if os.path.isfile(dst) and os.path.getmtime(dst) >= mtime:
+                    continue
+                if data is None:
+                    with open(src, 'rb') as f:
+                        data = f.read()
+                #静态文件只压缩一次，使用最高压缩级别
+                compressed = compress(data, encoding, level=9, quality=11)
+                if len(compressed) >= len(data):
+                    continue
+                with open(dst, 'wb') as f:
+                    f.write(compressed)
+                logging.info('compress %s: %s -> %s bytes' % (dst, len(data), len(compressed)))
+                count += 1
+    return count
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    print('%s files compressed.' % compress_static(root))
@@ -14,5 +14,87 @@ configs = {
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'json': {
+        #auto表示安装了orjson时使用orjson，否则使用标准库json
+        'backend': 'auto',
+        #同时进行的流式导出数，每个导出占用一个数据库连接直到发送完，超出时返回503
+        'max_streams': 3,
+        #流式导出读取一批或客户端接收一块的最长秒数，超时后断开，归还数据库连接
+        'stream_timeout': 30.0
+    },
+    'compress': {
+        'enabled': True,
+        #是否使用brotli，需要安装brotli模块
+        'brotli': True,
+        #小于此大小(字节)的响应不压缩
+        'min_size': 1024,
+        #大于此大小(字节)的响应在线程池中压缩
+        'executor_size': 65536,
+        #gzip压缩级别
+        'level': 6,
+        #brotli压缩质量，在线压缩不宜过高
+        'quality': 4
+    },
+    'templates': {
+        #生产模式：启动时编译并加载全部模板，不再检查模板文件是否修改
+        'production': False,
+        #生产模式下模板编译结果的缓存目录，为None时使用系统临时目录
+        'bytecode_cache': None,
+        #流式渲染时，积累多少个字符发送一次
+        'stream_buffer': 8192
+    },
+    'fragment_cache': {
+        #最多缓存的模板片段数
+        'maxsize': 1000,
+        #{% cache %}未指定时间时的默认缓存秒数
+        'ttl': 3600
+    },
+    'metrics': {
+        #开启后统计每个路由的耗时、状态码、SQL语句数，并在path提供Prometheus格式的指标
+        #指标不需要登录即可访问，对外提供服务时应在反向代理中限制访问
+        'enabled': False,
+        'path': '/metrics'
+    },
+    'render': {
+        #渲染Markdown的进程数，为0时全部在当前线程渲染
+        'workers': 2,
+        #小于此字符数的博客直接在当前线程渲染，进程间传输的开销比渲染本身更大
+        'inline_size': 16384,
+        #渲染超时秒数
+        'timeout': 5.0,
+        #进程池中最多等待和正在渲染的任务数，超出时等待空位，等待超时后渲染失败
+        'max_pending': 32,
+        #内存中渲染结果缓存的大小
+        'cache_bytes': 32 * 1024 * 1024,
+        #磁盘缓存目录，多个进程可共享，为None时不使用
+        'cache_path': None,
+        #磁盘缓存的大小
+        'cache_disk_bytes': 256 * 1024 * 1024,
+        #每个进程按顶层块缓存的渲染结果数，修改博客后只重新渲染改动的块，为0时不使用
+        'block_cache_size': 10000,
+        #每篇博客的渲染时间上限(秒)，超出时显示为纯文本，为None时不限制
+        'budget': 2.0,
+        #渲染引擎，regex为逐个正则表达式替换，tokenizer为逐行扫描，更快，输出相同
+        'engine': 'regex'
+    },
+    'logging': {
+        'level': 'INFO',
+        'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        #日志由后台线程写出，设为False时直接在当前线程写出
+        'queue': True,
+        #队列中最多等待写出的日志数，写出跟不上时丢弃新的日志，丢弃数见log_records_dropped_total指标
+        'queue_size': 10000,
+        #队列已满时WARNING及以上级别的日志最多等待的秒数，超时后才丢弃
+        'queue_timeout': 1.0,
+        #按logger名设置级别，orm为SQL语句，coroweb为URL处理函数的参数，access为访问日志
+        #调试时可设为DEBUG
+        'levels': {
+            'orm': 'WARNING',
+            'coroweb': 'INFO',
+            'access': 'INFO'
+        },
+        #按logger名设置采样比例，如'orm': 0.01表示只输出1%的日志，WARNING及以上级别不采样
+        'sample': {}
     }
 }
@@ -4,14 +4,18 @@
 '''aiohttp框架相对底层，因此重新封装一个web框架，
    减少编写的代码数量，且便于单独测试'''
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, hashlib
 
 from urllib import parse
 
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
 from aiohttp import web
 
 from apis import APIError
 
+logger = logging.getLogger(__name__)
+
 #此函数将以装饰器的方式给函数添加请求方法和请求路径两个属性，使其附带URL信息
 def get(path):
     def decorator(func):
@@ -33,6 +37,96 @@ def post(path):
         return wrapper
     return decorator
 
+#————————————————条件GET————————————————
+
+#根据内容或行的版本信息生成强ETag
+def make_etag(*parts):
+    '''
+    >>> make_etag(b'hello')
+    '"aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d"'
+    >>> make_etag('blog', '001', 1.5) == make_etag('blog', '001', 1.5)
+    True
+    '''
+    sha1 = hashlib.sha1()
+    for p in parts:
+        if not isinstance(p, bytes):
+            p = ('%s\x00' % p).encode('utf-8')
+        sha1.update(p)
+    return '"%s"' % sha1.hexdigest()
+
+#将时间戳格式化为HTTP日期，如'Wed, 21 Oct 2015 07:28:00 GMT'
+def http_date(t):
+    return formatdate(t, usegmt=True)
+
+#解析HTTP日期，返回时间戳，格式不正确时返回None
+def parse_http_date(s):
+    try:
+        t = parsedate_tz(s)
+        return None if t is None else mktime_tz(t)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+#将If-None-Match中的ETag规范化：去掉弱验证器前缀W/，以及压缩middleware追加的压缩方式后缀
+def _normalize_etag(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    for suffix in ('-gzip"', '-br"'):
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+#判断客户端缓存的资源是否仍然有效
+#有If-None-Match时只比较ETag，否则比较If-Modified-Since与Last-Modified
+def is_not_modified(request, etag=None, last_modified=None):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        tags = [_normalize_etag(t) for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        t = parse_http_date(if_modified_since)
+        #HTTP日期只精确到秒
+        return t is not None and int(last_modified) <= t
+    return False
+
+#记录资源的验证器并判断客户端缓存是否有效，URL处理函数可在渲染之前调用，有效时直接返回not_modified(request)
+#response_factory会使用记录下的验证器设置ETag和Last-Modified，未记录时根据响应内容计算ETag
+#页面内容随请求头变化时由vary指定，如按用户显示的页面为'Cookie'
+def check_not_modified(request, etag=None, last_modified=None, vary=None):
+    request.__validators__ = (etag, last_modified, vary)
+    return is_not_modified(request, etag, last_modified)
+
+def validator_headers(etag, last_modified, vary=None):
+    #要求浏览器每次都向服务器验证，避免根据Last-Modified进行启发式缓存
+    headers = {'Cache-Control': 'no-cache'}
+    if etag is not None:
+        headers['ETag'] = etag
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if vary is not None:
+        headers['Vary'] = vary
+    return headers
+
+#返回304响应
+def not_modified(request):
+    return web.HTTPNotModified(headers=validator_headers(*getattr(request, '__validators__', (None, None, None))))
+
+#为GET请求的200响应添加ETag和Last-Modified，若客户端缓存仍有效，改为返回304
+def conditional_response(request, resp):
+    if request.method not in ('GET', 'HEAD') or resp.status != 200 or not isinstance(resp.body, bytes):
+        return resp
+    etag, last_modified, vary = getattr(request, '__validators__', (None, None, None))
+    if etag is None:
+        etag = make_etag(resp.body)
+        request.__validators__ = (etag, last_modified, vary)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified(request)
+    resp.headers.update(validator_headers(etag, last_modified, vary))
+    return resp
+
 #形参(paramseters)的类型有5种
 #POSITIONAL_ONLY，即必须通过位置传入，Python中没有显式的语法来定义此类参数，多见于内建函数中
 #POSITIONAL_OR_KEYWORD，可以通过关键字或位置传入，这是默认的参数类型
@@ -101,13 +195,15 @@ class RequestHandler(object):
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
+        #路由模式，如/blog/{id}，用于按路由统计指标
+        self.__route__ = getattr(fn, '__route__', None)
         self._has_request_arg = has_request_arg(fn)
         self._has_var_kw_arg = has_var_kw_arg(fn)
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
 
-        logging.info('——————RequestHandler()->self._func: %s' % self._func)
+        logger.debug('——————RequestHandler()->self._func: %s', self._func)
         #self._named_kw_args为元组，格式化时要传入与元素数量相等的占位符,这里直接拼接了
         #直接拼接会报错，logging内部错误，占位符合提供的参数数量不等，但信息仍会以
         #Message: '——————RequestHandler()->self._named_kw_args:'
@@ -118,11 +214,11 @@ class RequestHandler(object):
         if self._required_kw_args:
             print('——————RequestHandler()->self._required_kw_args:', self._required_kw_args)
         if self._has_request_arg:
-            logging.info('——————RequestHandler()->self._has_request_arg: %s' % self._has_request_arg)
+            logger.debug('——————RequestHandler()->self._has_request_arg: %s', self._has_request_arg)
         if self._has_var_kw_arg:
-            logging.info('——————RequestHandler()->self._has_var_kw_arg: %s' % self._has_var_kw_arg)
+            logger.debug('——————RequestHandler()->self._has_var_kw_arg: %s', self._has_var_kw_arg)
         if self._has_named_kw_args:
-            logging.info('——————RequestHandler()->self._has_named_kw_args: %s' % self._has_named_kw_args)
+            logger.debug('——————RequestHandler()->self._has_named_kw_args: %s', self._has_named_kw_args)
 
     #定义__call__()方法后，可将其实例视为函数
     #即x(arg1, arg2...)等同于调用x.__call__(self, arg1, arg2)
@@ -146,7 +242,7 @@ class RequestHandler(object):
                         return web.HTTPBadRequest('JSON body must be object.')
                     kw = params
                     
-                    logging.info('——————RequestHandler()->JSON->kw: %s' % kw)
+                    logger.debug('——————RequestHandler()->JSON->kw: %s', kw)
 
                 #检查消息主体是否是表单信息
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
@@ -154,7 +250,7 @@ class RequestHandler(object):
                     params = yield from request.post()
                     kw = dict(**params)
 
-                    logging.info('——————RequestHandler()->x-www-form-urlencoded->kw: %s' % kw)
+                    logger.debug('——————RequestHandler()->x-www-form-urlencoded->kw: %s', kw)
                     
                 else:
                     return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
@@ -165,17 +261,18 @@ class RequestHandler(object):
                 if qs:
                     kw = dict()
                     #parse.parse_qs()，以字典形式返回查询字符串中的数据，'True'表示保留空白字符串
+                    params = parse.parse_qs(qs, True)
 
-                    logging.info('——————RequestHandler()->parse.parse_qs(): %s' % parse.parse_qs(qs, True))
+                    logger.debug('——————RequestHandler()->parse.parse_qs(): %s', params)
 
-                    for k, v in parse.parse_qs(qs, True).items():
+                    for k, v in params.items():
                         kw[k] = v[0]
         #经过以上处理，kw仍为空,则获取地址解析中的抽象匹配信息
         #不知道具体是什么，大概是根据URL参数返回文本
         if kw is None:
             kw = dict(**request.match_info)
 
-            logging.info('——————RequestHandler()->request.match_info: %s' % kw)
+            logger.debug('——————RequestHandler()->request.match_info: %s', kw)
             
         else:
             if not self._has_var_kw_arg and self._named_kw_args:
@@ -188,7 +285,7 @@ class RequestHandler(object):
             #检查并更新参数
             for k, v in request.match_info.items():
                 if k in kw:
-                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                     logger.warning('Duplicate arg name in named arg and kw args: %s', k)
                 kw[k] = v
         if self._has_request_arg:
             kw['request'] = request
@@ -197,7 +294,7 @@ class RequestHandler(object):
             for name in self._required_kw_args:
                 if not name in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        logger.debug('call with args: %s', kw)
         try:
             r = yield from self._func(**kw)
             return r
@@ -208,7 +305,9 @@ class RequestHandler(object):
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+    #记录静态文件的URL前缀和目录，供压缩middleware查找预压缩文件
+    app['__static__'] = ('/static/', path)
+    logger.info('add static %s => %s', '/static/', path)
 
 #add_route函数，用来注册一个URL处理函数
 def add_route(app, fn):
@@ -220,7 +319,7 @@ def add_route(app, fn):
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         #这里检测的是是否通过@asyncio.coroutine标记得到的协程，async def定义的结果为False
         fn = asyncio.coroutine(fn)
-    logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    logger.info('add route %s %s => %s(%s)', method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys()))
     #注册URL处理函数
     app.router.add_route(method, path, RequestHandler(app, fn))
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''模板片段缓存
+
+在模板中用 {% cache key, ttl %}...{% endcache %} 包住很少变化的部分，渲染结果按key缓存ttl秒，
+ttl省略时使用默认值。数据变化时在handlers中调用fragments.invalidate()使其失效'''
+
+import time
+
+from collections import OrderedDict
+
+from jinja2 import nodes
+
+from jinja2.ext import Extension
+
+#有容量上限的进程内缓存，超出时淘汰最久未使用的片段
+#模板只在事件循环所在线程中渲染，因此不需要加锁
+class FragmentCache(object):
+
+    def __init__(self, maxsize=1000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires < time.time():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    #使指定key的片段失效
+    def invalidate(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+
+    #使以prefix开头的所有片段失效，如某篇博客的全部片段
+    def invalidate_prefix(self, prefix):
+        for key in [k for k in self._data if k.startswith(prefix)]:
+            del self._data[key]
+
+    #判断key是否已缓存且未过期，不影响命中统计和淘汰顺序
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.time()
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+fragments = FragmentCache()
+
+#jinja2扩展，提供{% cache %}标签
+class FragmentCacheExtension(Extension):
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=fragments)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        #第一个参数为缓存的key，第二个参数为缓存秒数，可省略
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    #key为None时不缓存，如渲染失败时退回的纯文本
+    def _cache_support(self, key, ttl, caller):
+        if key is None:
+            return caller()
+        cache = self.environment.fragment_cache
+        rv = cache.get(key)
+        if rv is None:
+            rv = caller()
+            cache.set(key, rv, ttl)
+        return rv
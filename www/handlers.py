@@ -3,13 +3,17 @@
 
 '''URL处理函数'''
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, os, time, json, logging, hashlib, base64, asyncio
 
-import markdown2
+import orm, serializer, render, markdown2
+
+from fragment_cache import fragments
+
+from render_cache import ENGINE_VERSION
 
 from aiohttp import web
 
-from coroweb import get, post
+from coroweb import get, post, make_etag, check_not_modified, not_modified
 
 #尽量少用from module import *，因为判定一个特殊的函数或属性是从哪来的有些困难，
 #并且会造成调试和重构都更困难
@@ -17,6 +21,8 @@ from apis import Page, APIError, APIValueError, APIPermissionError, APIResourceN
 
 from models import User, Comment, Blog, next_id
 
+from plaintext import text2html
+
 from config import configs
 
 COOKIE_NAME = 'awesession'
@@ -39,11 +45,67 @@ def get_page_index(page_str):
         p = 1
     return p
 
-#将text格式转换成html格式
-def text2html(text):
-    #将对应字符转换成html的格式，并过滤掉空白字符
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
+#博客详情页每次显示/加载的评论数
+_COMMENTS_PAGE_SIZE = 20
+_COMMENTS_PAGE_MAX = 100
+
+#评论分页的游标，由一页中最后一条评论的created_at和id组成
+#按(created_at, id)降序翻页，翻页期间有新评论插入也不会出现重复或遗漏
+def comment2cursor(comment):
+    return '%r-%s' % (comment.created_at, comment.id)
+
+def cursor2args(cursor):
+    try:
+        created_at, cid = cursor.rsplit('-', 1)
+        return float(created_at), cid
+    except ValueError:
+        raise APIValueError('cursor')
+
+#获取某篇博客游标之后的一页评论，返回评论列表和下一页的游标，没有下一页时游标为None
+#查询走comments表上(blog_id, created_at)的索引，只读取limit + 1行
+@asyncio.coroutine
+def find_comments_page(blog_id, cursor=None, limit=_COMMENTS_PAGE_SIZE):
+    if cursor:
+        created_at, cid = cursor2args(cursor)
+        where = 'blog_id=? and (created_at<? or (created_at=? and id<?))'
+        args = [blog_id, created_at, created_at, cid]
+    else:
+        where = 'blog_id=?'
+        args = [blog_id]
+    #多取一条，用于判断是否还有下一页
+    comments = yield from Comment.findAll(where, args, orderBy='created_at desc, id desc', limit=limit + 1)
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = comment2cursor(comments[-1])
+    #html_content在保存评论时已生成，只有尚未回填的旧评论才需要现场转换
+    for c in comments:
+        if c.html_content is None:
+            c.html_content = text2html(c.content)
+    return comments, next_cursor
+
+#页面ETag的盐：模板文件和Markdown渲染引擎版本的hash
+#各Web进程相同，重启后不变，只有部署了新的模板或渲染引擎时旧的缓存才失效
+def _etag_salt():
+    sha1 = hashlib.sha1(ENGINE_VERSION.encode('utf-8'))
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            filename = os.path.join(dirpath, name)
+            sha1.update(os.path.relpath(filename, root).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+_ETAG_SALT = _etag_salt()
+
+#博客详情页的验证器：ETag由博客的更新时间和当前用户(页面显示用户名和评论框)决定
+#评论的增删会在同一事务中更新blogs.updated_at
+#页面因用户而异，不返回Last-Modified，否则切换用户后仍可能凭If-Modified-Since得到304
+def blog_page_validators(request, blog):
+    uid = request.__user__.id if request.__user__ else ''
+    return make_etag(_ETAG_SALT, 'blog', blog.id, repr(blog.updated_at), uid), None
 
 #根据用户的信息生成cookie
 def user2cookie(user, max_age):
@@ -77,6 +139,9 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        #同一请求内User.find()返回的是工作单元中的共享实例，复制一份再屏蔽密码
+        #以免影响本请求中其他需要读取真实密码的地方，如authenticate
+        user = User(**user)
         user.passwd = '******'
         #若验证成功，返回用户信息
         return user
@@ -105,21 +170,53 @@ def index(*, page='1'):
         'blogs': blogs
     }
 
+#博客正文片段的缓存key，包含正文的hash，修改正文后自然不会命中旧片段
+#不用updated_at，每条评论都会更新它，正文没变时片段仍然有效
+def blog_fragment_key(blog):
+    return 'blog:%s:%s' % (blog.id, hashlib.sha1(blog.content.encode('utf-8')).hexdigest())
+
+#博客变化时让相关的模板片段失效
+def invalidate_blog_fragments(blog_id=None):
+    if blog_id is not None:
+        fragments.invalidate_prefix('blog:%s:' % blog_id)
+    fragments.invalidate_prefix('pagination:')
+
 #博客详情页
 @get('/blog/{id}')
-def get_blog(id):
+def get_blog(id, request):
     #根据id从数据库中获取博客内容
     blog = yield from Blog.find(id)
-    #根据blog_id获取评论，按评论时间降序排列
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    #将博客和评论转换成html格式
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    if blog is None:
+        raise web.HTTPNotFound()
+    #博客和评论都未变化时直接返回304，不再查询评论和渲染页面
+    etag, last_modified = blog_page_validators(request, blog)
+    if check_not_modified(request, etag, last_modified, 'Cookie'):
+        return not_modified(request)
+    #只获取第一页评论，按评论时间降序排列，其余评论由页面滚动时通过/api/blogs/{id}/comments加载
+    comments, next_cursor = yield from find_comments_page(id)
+    #将博客转换成html格式，正文片段已缓存时不会真正转换
+    #片段在这里一次取出传给模板，模板渲染期间片段过期或被淘汰也不会在事件循环中渲染Markdown
+    #长博客交给渲染服务的进程池，不阻塞事件循环
+    fragment_key = blog_fragment_key(blog)
+    fragment = fragments.get(fragment_key)
+    if fragment is None:
+        #渲染队列已满、超时或超出渲染时间预算时显示转义后的纯文本，这样的正文不缓存
+        try:
+            blog.html_content = yield from render.render(blog.content)
+        except render.RenderError as e:
+            logging.warning('render blog %s failed: %s', id, e)
+            blog.html_content = markdown2.fallback_html(blog.content)
+        if blog.html_content.fallback:
+            fragment_key = None
     return {
         '__template__': 'blog.html',
+        'fragment_key': fragment_key,
+        'fragment': fragment,
+        #长博客以流的方式渲染，尽早发送<head>
+        '__stream__': True,
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'next_cursor': next_cursor
     }
 
 #注册页
@@ -148,6 +245,32 @@ def signout(request):
     logging.info('user signed out.')
     return r
 
+#列表API默认只返回的字段，正文等大字段需通过fields参数显式指定
+_BLOG_LIST_FIELDS = ('user_id', 'user_name', 'name', 'summary', 'comment_count', 'created_at', 'updated_at')
+_COMMENT_LIST_FIELDS = ('blog_id', 'user_id', 'user_name', 'content', 'created_at')
+_USER_LIST_FIELDS = ('email', 'name', 'admin', 'image', 'created_at')
+
+#解析列表API的fields参数，如fields=name,summary，fields=*表示全部字段
+def get_list_fields(model, fields, default):
+    if not fields:
+        return default
+    if fields == '*':
+        return None
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+    for f in names:
+        #需屏蔽的字段不允许单独查询
+        if f not in model.__mappings__ or f in model.__masked_fields__:
+            raise APIValueError('fields', 'Invalid field: %s' % f)
+    return names
+
+#列表API的stream参数，不分页，按创建时间降序以流的方式导出全部结果，只有管理员可以导出
+#stream=json输出JSON数组，stream=ndjson每行输出一个JSON对象
+def stream_list(request, model, stream, fields):
+    check_admin(request)
+    if stream not in ('json', 'ndjson'):
+        raise APIValueError('stream', 'Invalid stream format: %s' % stream)
+    return serializer.JSONStream(model.findStream(orderBy='created_at desc', fields=fields), stream == 'ndjson')
+
 #————————————————管理页面————————————————
 
 #管理重定向
@@ -157,26 +280,35 @@ def manage():
 
 #评论列表页
 @get('/manage/comments')
-def manage_comments(*, page='1'):
+def manage_comments(request, *, page='1'):
+    #服务端直接查询当前页内嵌到页面中，省去浏览器再请求一次API
+    data = yield from api_comments(request, page=page)
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'page_index': get_page_index(page),
+        'data': data
     }
 
 #博客列表页
 @get('/manage/blogs')
 def manage_blogs(*, page='1'):
+    #服务端直接查询当前页内嵌到页面中，省去浏览器再请求一次API
+    data = yield from api_blogs(page=page)
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': get_page_index(page),
+        'data': data
     }
 
 #用户列表页
 @get('/manage/users')
-def manage_users(*, page='1'):
+def manage_users(request, *, page='1'):
+    #服务端直接查询当前页内嵌到页面中，省去浏览器再请求一次API
+    data = yield from api_get_users(request, page=page)
     return {
         '__template__': 'manage_users.html',
-        'page_index': get_page_index(page)
+        'page_index': get_page_index(page),
+        'data': data
     }
 
 #创建博客页
@@ -202,15 +334,17 @@ def manage_edit_blog(*, id):
 
 #获取用户信息
 @get('/api/users')
-def api_get_users(*, page='1'):
+def api_get_users(request, *, page='1', fields='', stream=''):
     page_index = get_page_index(page)
+    fields = get_list_fields(User, fields, _USER_LIST_FIELDS)
+    if stream:
+        return stream_list(request, User, stream, fields)
     num = yield from User.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    for u in users:
-        u.passwd = '******'
+    #默认不查询passwd字段，fields=*时passwd由serializer屏蔽
+    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), fields=fields)
     return dict(page=p, users=users)
 
 #匹配邮箱与密码
@@ -240,10 +374,9 @@ def api_register_user(*, email, name, passwd):
     r = web.Response()
     #设置cookie
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passed = '******'
     r.content_type = 'application/json'
-    #返回json数据，ensure_ascii=False，即非ASCII字符将保持原样，不进行转义
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    #返回json数据，非ASCII字符保持原样，密码在序列化时被屏蔽
+    r.body = serializer.dumps(user)
     return r
 
 #用户登录验证
@@ -272,27 +405,31 @@ def authenticate(*, email, passwd):
     r = web.Response()
     #若验证成功，设置cookie
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    #将用户密码用'******'代替，防止泄露，数据库中储存的密码仍不变
-    user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    #用户密码在序列化时被屏蔽为'******'，防止泄露，数据库中储存的密码仍不变
+    r.body = serializer.dumps(user)
     return r
 
 #获取单条博客信息
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
+def api_get_blog(request, *, id):
     blog = yield from Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    if check_not_modified(request, make_etag('api:blog', blog.id, repr(blog.updated_at)), blog.updated_at):
+        return not_modified(request)
     return blog
 
 #获取博客信息
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', fields=''):
     page_index = get_page_index(page)
+    fields = get_list_fields(Blog, fields, _BLOG_LIST_FIELDS)
     num = yield from Blog.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), fields=fields)
     return dict(page=p, blogs=blogs)
 
 #创建博客
@@ -310,6 +447,7 @@ def api_create_blog(request, *, name, summary, content):
     #将博客信息存入数据库
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     yield from blog.save()
+    invalidate_blog_fragments()
     return blog
 
 #编辑博客
@@ -326,8 +464,15 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    #将博客信息更新到数据库
-    yield from blog.update()
+    blog.updated_at = time.time()
+    #只更新编辑过的字段，评论数等由其他请求同时修改的字段不会被覆盖
+    yield from blog.update(('name', 'summary', 'content', 'updated_at'))
+    invalidate_blog_fragments(id)
+    #预先渲染修改后的内容，只有改动过的块需要重新渲染，读者访问时直接命中缓存
+    try:
+        yield from render.render(blog.content)
+    except render.RenderError as e:
+        logging.warning('prerender blog %s failed: %s', id, e)
     return blog
 
 #删除博客
@@ -336,19 +481,33 @@ def api_delete_blog(request, *, id):
     check_admin(request)
     blog = yield from Blog.find(id)
     yield from blog.remove()
+    invalidate_blog_fragments(id)
     return dict(id=id)
 
 #获取评论信息
 @get('/api/comments')
-def api_comments(*, page='1'):
+def api_comments(request, *, page='1', fields='', stream=''):
     page_index = get_page_index(page)
+    fields = get_list_fields(Comment, fields, _COMMENT_LIST_FIELDS)
+    if stream:
+        return stream_list(request, Comment, stream, fields)
     num = yield from Comment.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), fields=fields)
     return dict(page=p, comments=comments)
 
+#按游标分页获取某篇博客的评论
+@get('/api/blogs/{id}/comments')
+def api_blog_comments(id, *, cursor='', limit=str(_COMMENTS_PAGE_SIZE)):
+    try:
+        limit = min(max(int(limit), 1), _COMMENTS_PAGE_MAX)
+    except ValueError:
+        raise APIValueError('limit')
+    comments, next_cursor = yield from find_comments_page(id, cursor, limit)
+    return dict(comments=comments, next_cursor=next_cursor)
+
 #创建评论
 @post('/api/blogs/{id}/comments')
 def api_create_comment(id, request, *, content):
@@ -361,8 +520,15 @@ def api_create_comment(id, request, *, content):
     blog = yield from Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    yield from comment.save()
+    content = content.strip()
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content, html_content=text2html(content))
+    #保存评论与博客评论数加1在同一事务中完成
+    #insertStatement()会为created_at填上默认值
+    insert = comment.insertStatement()
+    #同时更新博客的updated_at，使博客详情页的ETag失效
+    yield from orm.transaction([insert, Blog.incrStatement(blog.id, 'comment_count', 1, updated_at=comment.created_at)])
+    blog.comment_count = (blog.comment_count or 0) + 1
+    blog.updated_at = comment.created_at
     return comment
 
 #删除评论
@@ -372,5 +538,9 @@ def api_delete_comments(id, request):
     c = yield from Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    yield from c.remove()
+    #删除评论与博客评论数减1在同一事务中完成
+    #评论已被同时进行的另一个请求删除时，DELETE影响0行，评论数不再减1
+    decr = lambda affected: Blog.incrStatement(c.blog_id, 'comment_count', -1, updated_at=time.time()) if affected[0] else None
+    yield from orm.transaction([c.deleteStatement(), decr])
+    c.discard()
     return dict(id=id)
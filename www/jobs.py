@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''后台维护任务，可通过 python3 jobs.py <任务名> 单独执行'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import asyncio, sys
+
+import orm, render
+
+from models import Blog
+
+from config import configs
+
+#用一条UPDATE语句批量重新统计每篇博客的评论数，只改写与实际数量不一致的行
+_RECONCILE_COMMENT_COUNTS = '''update `blogs` b
+    left join (select `blog_id`, count(`id`) `num` from `comments` group by `blog_id`) c on c.`blog_id` = b.`id`
+    set b.`comment_count` = ifnull(c.`num`, 0)
+    where b.`comment_count` <> ifnull(c.`num`, 0)'''
+
+#校正blogs.comment_count，修复计数器可能出现的偏差，返回被修正的博客数
+@asyncio.coroutine
+def reconcile_comment_counts():
+    rows = yield from orm.execute(_RECONCILE_COMMENT_COUNTS, [])
+    logging.info('reconcile comment counts: %s blogs fixed' % rows)
+    return rows
+
+#通过渲染服务逐批重新渲染所有博客，检查是否都能在超时内完成，返回渲染失败的博客id
+@asyncio.coroutine
+def render_blogs(batch_size=50):
+    stream = Blog.findStream(orderBy='created_at desc', fields=['name', 'content'], batch_size=batch_size)
+    failed, total = [], 0
+    while True:
+        blogs = yield from stream.fetch()
+        if not blogs:
+            break
+        results = yield from render.render_many([b.content for b in blogs])
+        for blog, html in zip(blogs, results):
+            if isinstance(html, Exception):
+                logging.warning('render blog %s (%s) failed: %r', blog.id, blog.name, html)
+                failed.append(blog.id)
+        total += len(blogs)
+    logging.info('render blogs: %s rendered, %s failed', total, len(failed))
+    return failed
+
+#升级渲染引擎后重新渲染所有博客并写入渲染缓存，在多个进程中并行渲染
+#render.rebuild()在线程池中执行，所有博客共用一个进程池，渲染时不阻塞事件循环
+#正文按主键分批读取，每批都是很快完成的查询，读一批渲染一批，内存中不会有全部博客
+#设置了render的cache_path时缓存写入磁盘，供各Web进程共享，返回实际渲染的博客数
+@asyncio.coroutine
+def rebuild_render_cache(batch_size=500):
+    #没有磁盘缓存时结果只写入本进程的内存，任务结束就丢失了
+    if not render.cache.path:
+        logging.error('rebuild render cache: render.cache_path is not configured, nothing to rebuild')
+        return 0
+    loop = asyncio.get_event_loop()
+    total = 0
+    #在线程池中执行，每批的查询交回事件循环执行
+    def contents():
+        nonlocal total
+        last_id = ''
+        while True:
+            blogs = asyncio.run_coroutine_threadsafe(Blog.findAll('`id` > ?', [last_id], orderBy='`id`', limit=batch_size, fields=['content']), loop).result()
+            if not blogs:
+                return
+            total += len(blogs)
+            last_id = blogs[-1].id
+            for b in blogs:
+                yield b.content
+    rendered = yield from loop.run_in_executor(None, render.rebuild, contents())
+    logging.info('rebuild render cache: %s of %s blogs rendered', rendered, total)
+    return rendered
+
+JOBS = {
+    'reconcile_comment_counts': reconcile_comment_counts,
+    'render_blogs': render_blogs,
+    'rebuild_render_cache': rebuild_render_cache
+}
+
+@asyncio.coroutine
+def main(loop, names):
+    yield from orm.create_pool(loop=loop, **configs.db)
+    render.configure(**configs.render)
+    for name in names:
+        yield from JOBS[name]()
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    if not names or any(name not in JOBS for name in names):
+        print('Usage: ./jobs.py %s' % '|'.join(sorted(JOBS)))
+        exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, names))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''日志配置
+
+日志记录只放入队列，由后台线程格式化并写出，事件循环所在线程不会因写日志而阻塞
+队列的长度有上限，写出跟不上时丢弃新的日志并计数，不会无限占用内存，WARNING及以上级别的日志先等待空位，超时才丢弃
+可以按logger名设置级别和采样比例，如只输出1%的orm日志，WARNING及以上级别不采样'''
+
+import atexit, logging, queue, random
+
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+
+#同一进程内的队列不需要pickle，只在当前线程合并消息参数(参数可能在记录之后被修改)
+#时间、异常堆栈等的格式化和写出都在后台线程进行
+class LocalQueueHandler(QueueHandler):
+
+    def __init__(self, queue, timeout=1.0):
+        super(LocalQueueHandler, self).__init__(queue)
+        self.timeout = timeout
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    #队列已满时丢弃INFO及以下级别的日志，不等待也不输出错误
+    #WARNING及以上级别的日志最多等待timeout秒，等后台线程腾出空位
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
+
+#停止时队列可能已满，等待后台线程腾出空位再放入结束标记
+class LocalQueueListener(QueueListener):
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+#按比例随机丢弃日志，WARNING及以上级别总是保留
+class SampleFilter(logging.Filter):
+
+    def __init__(self, rate):
+        super(SampleFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+_listener = None
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+#退出时先写完队列中剩余的日志
+atexit.register(_stop_listener)
+
+#根据配置初始化日志，conf为config中的logging部分
+def setup(conf):
+    global _listener
+    _stop_listener()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(conf.get('format', logging.BASIC_FORMAT)))
+    if conf.get('queue', True):
+        q = queue.Queue(conf.get('queue_size', 10000))
+        root.addHandler(LocalQueueHandler(q, conf.get('queue_timeout', 1.0)))
+        _listener = LocalQueueListener(q, handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        root.addHandler(handler)
+    root.setLevel(conf.get('level', 'INFO'))
+    for name, level in conf.get('levels', {}).items():
+        logging.getLogger(name).setLevel(level)
+    for name, rate in conf.get('sample', {}).items():
+        logger = logging.getLogger(name)
+        for f in [f for f in logger.filters if isinstance(f, SampleFilter)]:
+            logger.removeFilter(f)
+        if rate < 1:
+            logger.addFilter(SampleFilter(rate))
@@ -92,8 +92,13 @@ try:
 except ImportError:
     from md5 import md5
 import optparse
-from random import random, randint
+from random import random, SystemRandom
+from itertools import count
 import codecs
+import threading
+import time
+from collections import OrderedDict
+from bisect import bisect_left
 
 
 #---- Python version compat
@@ -122,6 +127,11 @@ elif sys.version_info[0] >= 3:
     unicode = str
     base_string_type = str
 
+try:
+    RecursionError
+except NameError: # python < 3.5
+    RecursionError = RuntimeError
+
 
 
 #---- globals
@@ -132,9 +142,24 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
+# Escaped characters, code spans and HTML blocks and spans are swapped
+# out for placeholders while the text is processed. A placeholder is
+# "md5-" followed by 32 hex digits -- the format of the salted md5
+# hashes used before -- made of a nonce and a counter: a large document
+# needs thousands of them and hashing each one was slow. The nonce of a
+# document is a hash of its text, so a placeholder that is left in the
+# output (as some were before) is the same every time the text is
+# converted, and the text can't contain its own placeholders.
+_nonce_random = SystemRandom()
+def _new_nonce():
+    return "%016x" % _nonce_random.getrandbits(64)
+
+_process_nonce = _new_nonce()
+_process_counter = count()
 def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+    # A new placeholder on every call: the ones used while converting a
+    # document come from `_Placeholders`.
+    return "md5-%s%016x" % (_process_nonce, next(_process_counter))
 
 # Table of hash values for escaped characters:
 g_escape_table = dict([(ch, _hash_text(ch))
@@ -147,6 +172,10 @@ g_escape_table = dict([(ch, _hash_text(ch))
 class MarkdownError(Exception):
     pass
 
+class MarkdownTimeout(MarkdownError):
+    """Converting a document took longer than its `time_budget`."""
+    pass
+
 
 
 #---- public api
@@ -165,11 +194,175 @@ def markdown_path(path, encoding="utf-8",
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+             use_file_vars=False, block_cache=None, time_budget=None,
+             engine="regex"):
+    """Convert `text` with a pooled converter of the given options.
+
+    `engine` is "regex" for `Markdown` or "tokenizer" for
+    `TokenizerMarkdown`; both give the same output.
+    """
+    return _default_pool.convert(text, engine=engine, html4tags=html4tags,
+                                 tab_width=tab_width, safe_mode=safe_mode,
+                                 extras=extras, link_patterns=link_patterns,
+                                 use_file_vars=use_file_vars,
+                                 block_cache=block_cache,
+                                 time_budget=time_budget)
+
+def markdown_many(texts, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                  safe_mode=None, extras=None, link_patterns=None,
+                  use_file_vars=False, time_budget=None,
+                  processes=1, chunksize=8, engine="regex"):
+    """Convert each of `texts`, yielding the results in the same order.
+
+    One instance of the `engine` (see `markdown()`) converts all of
+    them. If `processes` isn't 1
+    they are converted by a `multiprocessing.Pool` of that many processes
+    -- one per CPU if None -- each with its own instance, handed
+    `chunksize` texts at a time. The options must then be picklable,
+    e.g. no lambdas in `link_patterns`.
+    """
+    options = dict(html4tags=html4tags, tab_width=tab_width,
+                   safe_mode=safe_mode, extras=extras,
+                   link_patterns=link_patterns, use_file_vars=use_file_vars,
+                   time_budget=time_budget)
+    if processes == 1:
+        md = _engine_class(engine)(**options)
+        for text in texts:
+            yield md.convert(text)
+        return
+    import multiprocessing
+    # Don't fork: the caller may hold locks in other threads (e.g. a
+    # logging listener) that the children could never release.
+    method = ("forkserver" if "forkserver" in
+              multiprocessing.get_all_start_methods() else "spawn")
+    pool = multiprocessing.get_context(method).Pool(
+        processes, _init_many_worker, (options, engine))
+    try:
+        for html in pool.imap(_convert_many_worker, texts, chunksize):
+            yield html
+    finally:
+        pool.terminate()
+
+# The converter of a `markdown_many()` worker process.
+_many_markdown = None
+
+def _init_many_worker(options, engine):
+    global _many_markdown
+    _many_markdown = _engine_class(engine)(**options)
+
+def _convert_many_worker(text):
+    return _many_markdown.convert(text)
+
+
+def fallback_html(text):
+    """Return `text` escaped and wrapped in <p> tags, as `Markdown.convert()`
+    does when it runs out of time.
+    """
+    if not isinstance(text, unicode):
+        text = unicode(text, 'utf-8')
+    text = re.sub("\r\n|\r", "\n", text).strip("\n")
+    grafs = ["<p>%s</p>" % _xml_escape_attr(graf)
+             for graf in re.split(r"\n{2,}", text)]
+    rv = UnicodeWithAttrs("\n\n".join(grafs) + "\n")
+    rv.fallback = True
+    return rv
+
+
+class BlockCache(object):
+    """A thread-safe LRU mapping for `Markdown.convert(text, block_cache)`.
+
+    Keeps the rendered HTML of at most `maxsize` top-level blocks.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MarkdownPool(object):
+    """A thread-safe pool of configured `Markdown` instances (or those
+    of another engine, see `markdown()`).
+
+    Building a `Markdown` object copies the escape table, massages the
+    extras and compiles the outdent regex. The pool keeps idle instances
+    per combination of constructor options and only calls `reset()`
+    (via `convert()`) between documents. An instance is checked out by
+    one caller at a time, so the pool can be shared by executor threads.
+
+    Options that can't be used as a key (e.g. `link_patterns` or extras
+    with unhashable arguments) get a fresh, unpooled instance.
+    """
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _key(self, options):
+        if options.get("link_patterns"):
+            return None
+        extras = options.get("extras")
+        if extras is None:
+            extras_key = None
+        elif isinstance(extras, dict):
+            extras_key = tuple(sorted(extras.items()))
+        else:
+            extras_key = tuple(sorted(extras))
+        key = (options.get("html4tags", False),
+               options.get("tab_width", DEFAULT_TAB_WIDTH),
+               options.get("safe_mode"), extras_key,
+               options.get("use_file_vars", False),
+               options.get("time_budget"))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def convert(self, text, block_cache=None, engine="regex", **options):
+        cls = _engine_class(engine)
+        key = self._key(options)
+        if key is None:
+            return cls(**options).convert(text, block_cache)
+        key = (engine,) + key
+        with self._lock:
+            idle = self._idle.get(key)
+            md = idle.pop() if idle else None
+        if md is None:
+            md = cls(**options)
+        try:
+            return md.convert(text, block_cache)
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(md)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+_default_pool = MarkdownPool()
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -192,8 +385,12 @@ class Markdown(object):
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
+    # When the conversion started plus `time_budget`, if there is one.
+    _deadline = None
+
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 time_budget=None):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -224,14 +421,23 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
+        self.time_budget = time_budget
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        self._instance_escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
-
-    def reset(self):
+            self._instance_escape_table['"'] = _hash_text('"')
+            self._instance_escape_table["'"] = _hash_text("'")
+        self._escape_table = self._instance_escape_table.copy()
+
+    def reset(self, text=None):
+        # `_encode_code()` adds per-document entries to the escape table
+        # and "toc" appends to `_toc`: start each document from scratch
+        # so a reused instance doesn't accumulate state. `text` is the
+        # document about to be converted.
+        self._escape_table = self._instance_escape_table.copy()
+        self._placeholder = _Placeholders(self._instance_escape_table, text)
+        self._toc = None
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
@@ -250,8 +456,37 @@ class Markdown(object):
     # should only be used in <a> tags with an "href" attribute.
     _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
 
-    def convert(self, text):
-        """Convert the given text."""
+    def convert(self, text, block_cache=None):
+        """Convert the given text.
+
+        If `block_cache` (a mapping such as `BlockCache`) is given, the
+        top-level blocks are rendered one by one and the HTML of each is
+        kept in the cache, so converting an edited version of a document
+        only re-runs the block gamut for the blocks that changed. The
+        result is identical to converting without a cache.
+
+        If converting takes longer than `time_budget` seconds, or the text
+        is nested too deeply to convert, the result is the text escaped
+        and wrapped in <p> tags instead, with a true `fallback` attribute.
+        """
+        if self.time_budget is not None:
+            self._deadline = time.time() + self.time_budget
+        try:
+            return self._convert(text, block_cache)
+        except (MarkdownTimeout, RecursionError):
+            return fallback_html(text)
+        finally:
+            self._deadline = None
+
+    def _check_time_budget(self):
+        # Called between the steps of a conversion: a single regex
+        # substitution can't be interrupted, so the budget is only a
+        # bound if each step takes linear time.
+        if self._deadline is not None and time.time() > self._deadline:
+            raise MarkdownTimeout("conversion took longer than %s seconds"
+                                  % self.time_budget)
+
+    def _convert(self, text, block_cache):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -261,7 +496,7 @@ class Markdown(object):
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
         # articles):
-        self.reset()
+        self.reset(text)
 
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
@@ -324,7 +559,10 @@ class Markdown(object):
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
 
-        text = self._run_block_gamut(text)
+        if block_cache is not None and self._can_run_incremental():
+            text = self._run_block_gamut_incremental(text, block_cache)
+        else:
+            text = self._run_block_gamut(text)
 
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
@@ -546,6 +784,9 @@ class Markdown(object):
         )
         """ % _block_tags_a,
         re.X | re.M)
+    _strict_tag_block_open_re = re.compile(r"^<(%s)\b" % _block_tags_a, re.M)
+    _strict_tag_block_close_re = re.compile(
+        r"^</(%s)>[ \t]*(?=\n+|\Z)" % _block_tags_a, re.M)
 
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
@@ -562,6 +803,9 @@ class Markdown(object):
         )
         """ % _block_tags_b,
         re.X | re.M)
+    _liberal_tag_block_open_re = re.compile(r"^<(%s)\b" % _block_tags_b, re.M)
+    _liberal_tag_block_close_re = re.compile(
+        r"</(%s)>[ \t]*(?=\n+|\Z)" % _block_tags_b)
 
     _html_markdown_attr_re = re.compile(
         r'''\s+markdown=("1"|'1')''')
@@ -577,14 +821,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._placeholder(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._placeholder(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._placeholder(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -615,10 +859,14 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        text = _sub_delimited(self._strict_tag_block_re, hash_html_block_sub,
+            text, self._strict_tag_block_open_re,
+            _last_group_starts(self._strict_tag_block_close_re, text))
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        text = _sub_delimited(self._liberal_tag_block_re, hash_html_block_sub,
+            text, self._liberal_tag_block_open_re,
+            _last_group_starts(self._liberal_tag_block_close_re, text))
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -677,7 +925,7 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._placeholder(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
 
@@ -772,42 +1020,228 @@ class Markdown(object):
     def _run_block_gamut(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
+        for step in self._block_gamut_steps():
+            self._check_time_budget()
+            text = step(text)
+        return text
 
+    def _block_gamut_steps(self):
+        steps = []
         if "fenced-code-blocks" in self.extras:
-            text = self._do_fenced_code_blocks(text)
-
-        text = self._do_headers(text)
-
-        # Do Horizontal Rules:
-        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
-        # you wish, you may use spaces between the hyphens or asterisks."
-        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
-        # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+            steps.append(self._do_fenced_code_blocks)
 
-        text = self._do_lists(text)
+        steps.append(self._do_headers)
+        steps.append(self._do_horizontal_rules)
+        steps.append(self._do_lists)
 
         if "pyshell" in self.extras:
-            text = self._prepare_pyshell_blocks(text)
+            steps.append(self._prepare_pyshell_blocks)
         if "wiki-tables" in self.extras:
-            text = self._do_wiki_tables(text)
+            steps.append(self._do_wiki_tables)
         if "tables" in self.extras:
-            text = self._do_tables(text)
+            steps.append(self._do_tables)
 
-        text = self._do_code_blocks(text)
-
-        text = self._do_block_quotes(text)
+        steps.append(self._do_code_blocks)
+        steps.append(self._do_block_quotes)
 
         # We already ran _HashHTMLBlocks() before, in Markdown(), but that
         # was to escape raw HTML in the original Markdown source. This time,
         # we're escaping the markup we've just created, so that we don't wrap
         # <p> tags around block-level tags.
-        text = self._hash_html_blocks(text)
+        steps.append(self._hash_html_blocks)
 
-        text = self._form_paragraphs(text)
+        steps.append(self._form_paragraphs)
+        return steps
 
-        return text
+    def _do_horizontal_rules(self, text):
+        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
+        # you wish, you may use spaces between the hyphens or asterisks."
+        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
+        # hr chars to one or two. We'll reproduce that limit here.
+        hr = "\n<hr"+self.empty_element_suffix+"\n"
+        return re.sub(self._hr_re, hr, text)
+
+    # Boundaries between top-level blocks for incremental conversion: one
+    # or more blank lines followed by an unindented line that can't
+    # continue a preceding list, code block or blockquote.
+    _block_split_re = re.compile(r"\n{2,}(?=[^ \t\n>])(?![*+-][ \t]|\d+\.[ \t])")
+    # An empty list item takes in the paragraph after the blank line.
+    _empty_list_item_re = re.compile(r"[ \t]*(?:[*+-]|\d+\.)[ \t]+\Z")
+
+    # The extras that `_run_block_gamut_incremental()` supports. Anything
+    # else falls back to running the block gamut over the whole document.
+    _incremental_extras = set(["code-friendly", "fenced-code-blocks",
+        "footnotes", "header-ids", "nofollow", "toc"])
+
+    def _can_run_incremental(self):
+        return (not self.safe_mode
+                and self._incremental_extras.issuperset(self.extras))
+
+    def _incremental_context(self):
+        # Everything outside a block that its rendering reads: the
+        # options and the link/footnote definitions of the document.
+        context = [self.empty_element_suffix, self.tab_width,
+                   sorted(self.extras.items()),
+                   sorted(self.urls.items()), sorted(self.titles.items())]
+        if "footnotes" in self.extras:
+            context.append(sorted(self.footnotes.items()))
+        return md5(repr(context).encode("utf-8")).hexdigest()
+
+    def _incremental_state(self):
+        # Grows whenever a header id is assigned or a footnote is
+        # referenced.
+        state = 0
+        if "header-ids" in self.extras:
+            state += len(self._count_from_header_id.recorded)
+        if "footnotes" in self.extras:
+            state += len(self.footnote_ids)
+        return state
+
+    # An opening block-level tag or comment left unhashed by
+    # `_hash_html_blocks()` could be matched with a closing one further down
+    # the document, so the block can't be rendered on its own.
+    _open_html_block_re = re.compile(r"^<(%s)\b|<!--" % _block_tags_a, re.M)
+    # A closing block-level tag left by the first `_hash_html_blocks()`
+    # could end an HTML block the gamut makes in another block, e.g. the
+    # <div> of a highlighted code block.
+    _close_html_block_re = re.compile(r"</(%s)>" % _block_tags_a)
+
+    def _run_block_gamut_incremental(self, text, block_cache):
+        """Run the block gamut over `text` block by block.
+
+        Header ids and footnote numbers are assigned in the order the
+        gamut steps reach them over the whole document -- e.g. all
+        headers before any list item -- so the blocks that aren't in
+        `block_cache` are stepped together, one gamut step at a time,
+        exactly like the full document would be. Blocks that assign a
+        header id or number a footnote depend on their position and are
+        never cached. A cache entry holds the HTML of a block and the
+        escape table entries added by each step, which are replayed at
+        the same point so the escape table ends up in the same order,
+        with the placeholders of this document.
+        """
+        context = self._incremental_context()
+        initial_escape_table = self._escape_table
+        escape_table = self._escape_table = _RecordingDict(initial_escape_table)
+        if "header-ids" in self.extras:
+            self._count_from_header_id = _RecordingDict()
+
+        if self._close_html_block_re.search(text):
+            return self._run_block_gamut(text)
+        texts = {}
+        if "md5-" in text:
+            texts = dict((v, k) for k, v in self._placeholder.keys.items())
+        keys, entries, grafs, placeholders = [], [], [], []
+        start = 0
+        ends = [m.end() for m in self._block_split_re.finditer(text)
+                if not self._empty_list_item_re.match(
+                    text, text.rfind("\n", 0, m.start()) + 1, m.start())]
+        if "fenced-code-blocks" in self.extras:
+            fences = list(self._fenced_code_block_re.finditer(text))
+            if any(m.group(1) for m in fences):
+                # A highlighted code block is an HTML block (<div>) that
+                # HTML further down the document can take in.
+                return self._run_block_gamut(text)
+            # A fenced code block may contain blank lines followed by
+            # unindented text: keep it in one block.
+            fences = [m.span() for m in fences]
+            ends = [end for end in ends
+                    if not any(s < end < e for s, e in fences)]
+        for end in ends + [len(text)]:
+            block = text[start:end]
+            start = end
+            if not block.strip("\n"):
+                continue
+            key, found = self._block_key(context, block, texts)
+            keys.append(key)
+            entries.append(block_cache.get(key))
+            grafs.append(block)
+            placeholders.append(found)
+        if not grafs:
+            return self._run_block_gamut(text)
+
+        pending = [i for i, entry in enumerate(entries) if entry is None]
+        escapes = dict((i, []) for i in pending)
+        stateless = set(pending)
+        for n, step in enumerate(self._block_gamut_steps()):
+            for i, entry in enumerate(entries):
+                self._check_time_budget()
+                if entry is not None:
+                    for k, v in entry[1][n]:
+                        escape_table[k] = self._placeholder(k)
+                    continue
+                state = self._incremental_state()
+                n_escapes = len(escape_table.recorded)
+                grafs[i] = step(grafs[i])
+                if (step == self._hash_html_blocks
+                        and self._open_html_block_re.search(grafs[i])):
+                    # Start over on the whole document.
+                    self._escape_table = initial_escape_table
+                    self._toc = None
+                    if "header-ids" in self.extras:
+                        self._count_from_header_id = {}
+                    if "footnotes" in self.extras:
+                        self.footnote_ids = []
+                    return self._run_block_gamut(text)
+                escapes[i].append(escape_table.recorded[n_escapes:])
+                if self._incremental_state() != state:
+                    stateless.discard(i)
+
+        for i in stateless:
+            block_cache[keys[i]] = (grafs[i], escapes[i], placeholders[i])
+        for i, entry in enumerate(entries):
+            if entry is not None:
+                grafs[i] = self._replace_placeholders(entry)
+        return "\n\n".join(grafs)
+
+    _placeholder_re = re.compile(r"md5-[0-9a-f]{32}")
+
+    def _block_key(self, context, block, texts):
+        """Return the block cache key of `block` and the placeholders in
+        it with the text each stands for.
+
+        Placeholders are made per document, so those already in the
+        block -- of HTML blocks and fenced code blocks -- are keyed by
+        their text. `texts` maps the placeholders to their text.
+        """
+        if "md5-" not in block:
+            return context + md5(block.encode("utf-8")).hexdigest(), []
+        found = []
+        key_text = self._placeholder_key_text(block, texts, found)
+        return context + md5(key_text.encode("utf-8")).hexdigest(), found
+
+    def _placeholder_key_text(self, text, texts, found):
+        # The text a placeholder stands for may hold others, e.g. a
+        # fenced code block hashed again as an HTML block.
+        parts = []
+        def sub(match):
+            p = match.group(0)
+            t = texts.get(p)
+            if t is None:
+                # Text that only looks like a placeholder.
+                parts.append((True, p))
+            else:
+                found.append((t, p))
+                if "md5-" in t:
+                    t = self._placeholder_key_text(t, texts, found)
+                parts.append((False, t))
+            return "md5-" + "0" * 32
+        return self._placeholder_re.sub(sub, text) + repr(parts)
+
+    def _replace_placeholders(self, entry):
+        # A cached block holds the placeholders of the document it was
+        # rendered in: swap in the ones of this document.
+        graf, escapes, placeholders = entry
+        for step_escapes in escapes:
+            for k, v in step_escapes:
+                key = self._placeholder(k)
+                if key != v:
+                    graf = graf.replace(v, key)
+        for k, v in placeholders:
+            key = self._placeholder(k)
+            if key != v:
+                graf = graf.replace(v, key)
+        return graf
 
     def _pyshell_block_sub(self, match):
         lines = match.group(0).splitlines(0)
@@ -938,6 +1372,7 @@ class Markdown(object):
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        self._check_time_budget()
 
         text = self._do_code_spans(text)
 
@@ -987,6 +1422,19 @@ class Markdown(object):
         )
         """, re.X)
 
+    def _sorta_html_tokenize(self, text):
+        """Split `text` into alternating text and markup tokens with
+        `_sorta_html_tokenize_re`.
+
+        Every token ends with '>', so only the text up to the last '>' is
+        split: otherwise each '<' after it (e.g. an unclosed auto-link)
+        would make the regex scan to the end of the text.
+        """
+        end = text.rfind('>') + 1
+        tokens = self._sorta_html_tokenize_re.split(text[:end])
+        tokens[-1] += text[end:]
+        return tokens
+
     def _escape_special_chars(self, text):
         # Python markdown note: the HTML tokenization here differs from
         # that in Markdown.pl, hence the behaviour for subtle cases can
@@ -996,7 +1444,7 @@ class Markdown(object):
         # here.
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._sorta_html_tokenize(text):
             if is_html_markup:
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
@@ -1023,10 +1471,10 @@ class Markdown(object):
 
         tokens = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._sorta_html_tokenize(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._placeholder(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1055,15 +1503,6 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _inline_link_title = re.compile(r'''
-            (                   # \1
-              [ \t]+
-              (['"])            # quote char = \2
-              (?P<title>.*?)
-              \2
-            )?                  # title is optional
-          \)$
-        ''', re.X | re.S)
     _tail_of_reference_link_re = re.compile(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
@@ -1084,37 +1523,58 @@ class Markdown(object):
         match = self._whitespace.match(text, start)
         return match.end()
 
-    def _find_balanced(self, text, start, open_c, close_c):
-        """Returns the index where the open_c and close_c characters balance
-        out - the same number of open_c and close_c are encountered - or the
-        end of string if it's reached before the balance point is found.
+    # The start of an inline link title: whitespace and the quote that is
+    # also right before the link's closing paren.
+    _link_title_start_res = {
+        '"': re.compile(r'(?<![ \t])[ \t]+"'),
+        "'": re.compile(r"(?<![ \t])[ \t]+'"),
+    }
+
+    def _find_link_title(self, text, start, end):
+        r"""Find the optional title at the end of text[start:end], the tail
+        of an inline link after the url, which must end with ')'. Returns
+        the (end of the url, title) or (None, None).
+
+        This is the first match of
+
+            ([ \t]+(['"])(?P<title>.*?)\2)?\)$
+
+        but the regex is tried at every position and each try can run to
+        `end`; here the opening quote is searched for only once.
         """
-        i = start
-        l = len(text)
-        count = 1
-        while count > 0 and i < l:
-            if text[i] == open_c:
-                count += 1
-            elif text[i] == close_c:
-                count -= 1
-            i += 1
-        return i
+        # `\)$`, where `$` also matches before a trailing newline.
+        close = end - 1
+        if close >= start and text[close] == '\n':
+            close -= 1
+        if close < start or text[close] != ')':
+            return None, None
+        quote = text[close-1]
+        if close - 1 > start and quote in self._link_title_start_res:
+            match = self._link_title_start_res[quote].search(text, start,
+                                                             close - 1)
+            if match:
+                return match.start(), text[match.end():close-1]
+        return close, None
 
-    def _extract_url_and_title(self, text, start):
+    def _extract_url_and_title(self, text, start, end=None, balance=None):
         """Extracts the url and (optional) title from the tail of a link"""
         # text[start] equals the opening parenthesis
-        idx = self._find_non_whitespace(text, start+1)
-        if idx == len(text):
+        if end is None:
+            end = len(text)
+        if balance is None:
+            balance = _BalanceIndex(text)
+        idx = min(self._find_non_whitespace(text, start+1), end)
+        if idx == end:
             return None, None, None
         end_idx = idx
         has_anglebrackets = text[idx] == "<"
         if has_anglebrackets:
-            end_idx = self._find_balanced(text, end_idx+1, "<", ">")
-        end_idx = self._find_balanced(text, end_idx, "(", ")")
-        match = self._inline_link_title.search(text, idx, end_idx)
-        if not match:
+            end_idx = balance.find("<", ">", end_idx+1, end) + 1 or end
+        end_idx = balance.find("(", ")", end_idx, end) + 1 or end
+        url_end, title = self._find_link_title(text, idx, end_idx)
+        if url_end is None:
             return None, None, None
-        url, title = text[idx:match.start()], match.group("title")
+        url = text[idx:url_end]
         if has_anglebrackets:
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
@@ -1127,15 +1587,28 @@ class Markdown(object):
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
         """
+        return ''.join(self._do_links_in(text, 0, len(text),
+                                         _BalanceIndex(text), True))
+
+    def _do_links_in(self, text, pos, end, balance, anchor_allowed):
+        """Process the links in text[pos:end] and return the pieces of the
+        result.
+
+        `balance` is a `_BalanceIndex` of `text`: the closing bracket or
+        paren of every candidate link is looked up in it instead of
+        scanning for it, which is quadratic on text full of unmatched
+        ones. The text is only read, never spliced, and the link text of
+        an anchor is processed in place with `anchor_allowed` false:
+        img links are supported inside anchors, but not anchors inside
+        anchors.
+        """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
-
-        curr_pos = 0
+        pieces = []
+        emitted = pos   # text[pos:emitted] is in `pieces`
+        curr_pos = pos
         while True: # Handle the next link.
+            self._check_time_budget()
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
             # - a reference anchor: [text][id]
@@ -1151,58 +1624,52 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
+            start_idx = text.find('[', curr_pos, end)
+            if start_idx == -1:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = balance.find("[", "]", start_idx+1,
+                             min(start_idx+MAX_LINK_TEXT_SENTINEL, end))
+            if p == -1:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
                 continue
-            link_text = text[start_idx+1:p]
+            # The link text is only copied once it's known to be a link.
+            link_start, link_end = start_idx+1, p
 
             # Possibly a footnote ref?
-            if "footnotes" in self.extras and link_text.startswith("^"):
-                normed_id = re.sub(r'\W', '-', link_text[1:])
+            if ("footnotes" in self.extras
+                    and text.startswith("^", link_start, link_end)):
+                normed_id = re.sub(r'\W', '-', text[link_start+1:link_end])
                 if normed_id in self.footnotes:
                     self.footnote_ids.append(normed_id)
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
-                else:
-                    # This id isn't defined, leave the markup alone.
-                    curr_pos = p+1
+                    pieces.append(text[emitted:start_idx])
+                    pieces.append(result)
+                    emitted = p+1
+                curr_pos = p+1
                 continue
 
             # Now determine what this is by the remainder.
             p += 1
-            if p == text_length:
-                return text
+            if p == end:
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
-                url, title, url_end_idx = self._extract_url_and_title(text, p)
+                url, title, url_end_idx = self._extract_url_and_title(
+                    text, p, end, balance)
                 if url is not None:
                     # Handle an inline anchor or img.
+                    link_text = text[link_start:link_end]
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
@@ -1226,18 +1693,15 @@ class Markdown(object):
                                title_str, img_class_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
+                        pieces.append(text[emitted:start_idx])
+                        pieces.append(result)
+                        emitted = curr_pos = url_end_idx
+                    elif anchor_allowed:
                         result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        pieces.append(text[emitted:start_idx])
+                        self._add_anchor(pieces, result_head, text,
+                                         link_start, link_end, balance)
+                        emitted = curr_pos = url_end_idx
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1245,9 +1709,10 @@ class Markdown(object):
 
             # Reference anchor or img?
             else:
-                match = self._tail_of_reference_link_re.match(text, p)
+                match = self._tail_of_reference_link_re.match(text, p, end)
                 if match:
                     # Handle a reference-style anchor or img.
+                    link_text = text[link_start:link_end]
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
@@ -1277,20 +1742,15 @@ class Markdown(object):
                                    title_str, img_class_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
+                            pieces.append(text[emitted:start_idx])
+                            pieces.append(result)
+                            emitted = curr_pos = match.end()
+                        elif anchor_allowed:
                             result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            pieces.append(text[emitted:start_idx])
+                            self._add_anchor(pieces, result_head, text,
+                                             link_start, link_end, balance)
+                            emitted = curr_pos = match.end()
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1302,7 +1762,22 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        pieces.append(text[emitted:end])
+        return pieces
+
+    def _add_anchor(self, pieces, result_head, text, link_start, link_end,
+                    balance):
+        # The link text may contain img links.
+        if "smarty-pants" in self.extras:
+            result_head = result_head.replace('"', self._escape_table['"'])
+            link_text = text[link_start:link_end].replace(
+                '"', self._escape_table['"'])
+            text, link_start, link_end = link_text, 0, len(link_text)
+            balance = _BalanceIndex(text)
+        pieces.append(result_head)
+        pieces.extend(self._do_links_in(text, link_start, link_end, balance,
+                                        False))
+        pieces.append('</a>')
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1338,7 +1813,10 @@ class Markdown(object):
         |
         (^(\#{1,6})  # \1 = string of #'s
         [ \t]%s
-        (.+?)       # \2 = Header text
+        (.|..*?     # \2 = Header text. Past its first character it
+        (?<![ \t])  # doesn't end with whitespace, or inside a run of
+        (?!(?<=[^\\]\#)\#) # unescaped '#': ending one character
+        )           # earlier works too, and trying those is quadratic
         [ \t]*
         (?<!\\)     # ensure not an escaped trailing '#'
         \#*         # optional closing #'s (not counted)
@@ -1409,55 +1887,85 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # We match ul and ol separately to avoid adjacent lists of different
+        # types running into each other (see issue #16).
+        list_res = []
+        for marker_pat in (self._marker_ul, self._marker_ol):
+            less_than_tab = self.tab_width - 1
+            whole_list = r"""
+                (                   # \1 = whole list
+                  (                 # \2
+                    [ ]{0,%d}
+                    (%s)            # \3 = first list item marker
+                    [ \t]+
+                    (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+                  )
+                  (?:.+?)
+                  (                 # \4
+                      \Z
+                    |
+                      \n{2,}
+                      (?=\S)
+                      (?!           # Negative lookahead for another list item marker
+                        [ \t]*
+                        %s[ \t]+
+                      )
+                  )
+                )
+            """ % (less_than_tab, marker_pat, marker_pat)
+            if self.list_level:  # sub-list
+                list_res.append(re.compile("^"+whole_list, re.X | re.M | re.S))
+            else:
+                list_res.append(re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                                           re.X | re.M | re.S))
+
+        # Iterate over each *non-overlapping* list match. `hits` holds the
+        # start of the next match of each list style (None if there is
+        # none) and the match, if it was made on the current text. The
+        # style that didn't come first keeps its hit: searching again
+        # after every list would rescan the text up to it each time.
         pos = 0
+        hits = [self._search_hit(list_re, text, pos) for list_re in list_res]
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            # Find the *first* hit for either list style (ul or ol).
+            firsts = [(hit[0], i) for i, hit in enumerate(hits) if hit]
+            if not firsts:
                 break
-            hits.sort()
-            match = hits[0][1]
-            start, end = match.span()
+            start, first = min(firsts)
+            match = hits[first][1] or list_res[first].match(text, start)
+            end = match.end()
             middle = self._list_sub(match)
             text = text[:start] + middle + text[end:]
             pos = start + len(middle) # start pos for next attempted match
 
+            for i, list_re in enumerate(list_res):
+                hit = hits[i]
+                if i != first and (hit is None or hit[0] >= end + 2):
+                    # Only a match starting right after the replaced list
+                    # (which `(?<=\n\n)` sees) can be new.
+                    near = self._search_hit(list_re, text, pos, pos + 2)
+                    if near is not None:
+                        hits[i] = near
+                    elif hit is not None:
+                        hits[i] = (hit[0] + pos - end, None)
+                else:
+                    hits[i] = self._search_hit(list_re, text, pos)
+
         return text
 
+    def _search_hit(self, regex, text, pos, last=None):
+        """Return the (start, match) of the first match of `regex` at or
+        after `pos` (and before `last`, if given), or None.
+        """
+        if last is None:
+            match = regex.search(text, pos)
+            return match and (match.start(), match)
+        for start in range(pos, min(last, len(text) + 1)):
+            match = regex.match(text, start)
+            if match:
+                return start, match
+        return None
+
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
@@ -1516,36 +2024,11 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _get_pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _color_with_pygments(codeblock, lexer, formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1704,7 +2187,7 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._placeholder(text)
         self._escape_table[text] = hashed
         return hashed
 
@@ -1712,16 +2195,47 @@ class Markdown(object):
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
     _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
     _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    # Where each of the above can start, for `_sub_delimited()`.
+    _strong_open_re = re.compile(r"(?=(\*\*|__))")
+    _em_open_re = re.compile(r"(\*|_)")
+    _code_friendly_strong_open_re = re.compile(r"(?=(\*\*))")
+    _code_friendly_em_open_re = re.compile(r"(\*)")
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = self._sub_emphasis(self._code_friendly_strong_re,
+                lambda m: "<strong>%s</strong>" % m.group(1), text, ("**",),
+                self._code_friendly_strong_open_re)
+            text = self._sub_emphasis(self._code_friendly_em_re,
+                lambda m: "<em>%s</em>" % m.group(1), text, ("*",),
+                self._code_friendly_em_open_re)
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = self._sub_emphasis(self._strong_re,
+                lambda m: "<strong>%s</strong>" % m.group(2), text,
+                ("**", "__"), self._strong_open_re)
+            text = self._sub_emphasis(self._em_re,
+                lambda m: "<em>%s</em>" % m.group(2), text, ("*", "_"),
+                self._em_open_re)
         return text
 
+    def _sub_emphasis(self, regex, repl, text, delimiters, open_re):
+        # `regex.sub()` tries each delimiter in `text` as the opening one
+        # and scans to the end of the text when it isn't closed; with
+        # more than a few of those use `_sub_delimited()` instead. A
+        # closing delimiter follows a non-whitespace character.
+        last_close = {}
+        unclosed = 0
+        for delim in delimiters:
+            i = text.rfind(delim)
+            while i > 0 and text[i-1].isspace():
+                i = text.rfind(delim, 0, i)
+            if i > 0:
+                last_close[delim] = i
+            unclosed += text.count(delim, max(i, 0))
+        if unclosed <= 8:
+            return regex.sub(repl, text)
+        return _sub_delimited(regex, repl, text, open_re, last_close)
+
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
@@ -1957,7 +2471,7 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._placeholder(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
         for hash, link in list(link_from_hash.items()):
@@ -1988,8 +2502,671 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class _Unsupported(Exception):
+    """Raised by `TokenizerMarkdown` for text it doesn't convert exactly
+    like `Markdown`: the text is then converted by `Markdown` instead."""
+
+class _BlockHtml(unicode):
+    """The HTML of a block among the lines `TokenizerMarkdown` walks."""
+
+class TokenizerMarkdown(Markdown):
+    """A faster converter with the same output as `Markdown`.
+
+    `Markdown` runs a regex substitution over the whole document for each
+    construct. Here the document is split into lines once and each step
+    of the block gamut -- headers and rules, lists, code blocks,
+    blockquotes, paragraphs -- is a walk over the lines, with the blocks
+    already rendered kept as `_BlockHtml` lines. The spans of a block are
+    scanned once for code spans, backslash escapes and tags; links and
+    emphasis are done by the `Markdown` code on the block's text. Lists
+    with sub-lists and nested blockquotes are handed to the `Markdown`
+    code too. The placeholders are swapped back in one pass at the end.
+
+    Only a subset is handled this way: block-level HTML, e-mail auto-links,
+    most extras and most options are not. A document using them is
+    converted by `Markdown` -- `engine` tells which one converted the last
+    document -- so the output is always the same. The `block_cache` of
+    `convert()` is only used then.
+    """
+    # The extras the tokenizer handles itself.
+    tokenizer_extras = frozenset(["code-friendly", "fenced-code-blocks",
+                                  "nofollow"])
+
+    # The engine that converted the last document: "tokenizer" or "regex".
+    engine = None
+
+    # True while the tokenizer converts a document (the `Markdown` methods
+    # it shares with the fallback dispatch on it).
+    _tokenizing = False
+
+    def _convert(self, text, block_cache):
+        if self._tokenizer_can_convert():
+            self._tokenizing = True
+            try:
+                rv = self._convert_tokens(text)
+                self.engine = "tokenizer"
+                return rv
+            except _Unsupported:
+                pass
+            finally:
+                self._tokenizing = False
+        self.engine = "regex"
+        return Markdown._convert(self, text, block_cache)
+
+    def _tokenizer_can_convert(self):
+        return (not self.safe_mode and not self.link_patterns
+                and not self.use_file_vars and self.tab_width == 4
+                and self.tokenizer_extras.issuperset(self._instance_extras))
+
+    # A line starting with block-level HTML, also in a blockquote or a
+    # code span (which `_hash_html_blocks()` would take it out of).
+    _html_line_re = re.compile(r"^(?:[ \t]*>[ \t]?)*[ ]{0,3}<(?:(?:%s|hr)\b|!--)"
+                               % Markdown._block_tags_a, re.M)
+    # The same at any indent, for the lists and blockquotes given over
+    # to `_process_list_items()` and `_run_block_gamut()`.
+    _nested_html_line_re = re.compile(r"^[ \t>]*<(?:(?:%s|hr)\b|!--)"
+                                      % Markdown._block_tags_a, re.M)
+
+    def _convert_tokens(self, text):
+        # Same preparation as `Markdown._convert()`.
+        self.reset(text)
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        text = re.sub("\r\n|\r", "\n", text)
+        text += "\n\n"
+        text = self._detab(text)
+        text = self._ws_only_line_re.sub("", text)
+        text = self.preprocess(text)
+
+        # The HTML of the fenced code blocks by the placeholder line
+        # standing in for them.
+        self._block_html = {}
+        # The spans with a backslash that doesn't escape anything:
+        # `Markdown` also swaps "\" + the content of a code span or block
+        # converted before.
+        self._backslash_texts = []
+
+        if "fenced-code-blocks" in self.extras:
+            text = self._fenced_code_block_re.sub(
+                self._fenced_code_block_token_sub, text)
+        if "</code>" in text:
+            raise _Unsupported("</code>")
+        if self._close_html_block_re.search(text):
+            raise _Unsupported("closing HTML tag")
+        text = self._strip_link_definitions(text)
+        text = "\n\n".join(self._block_tokens(text))
+        if self._backslash_texts:
+            for code in self._escape_table:
+                if code not in self._instance_escape_table and any(
+                        "\\" + code in t for t in self._backslash_texts):
+                    raise _Unsupported("backslash before code")
+
+        text = self.postprocess(text)
+        texts = dict((hash, ch) for ch, hash in self._escape_table.items())
+        text = self._placeholder_re.sub(
+            lambda m: texts.get(m.group(0), m.group(0)), text)
+        if "nofollow" in self.extras:
+            text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        text += "\n"
+        return UnicodeWithAttrs(text)
+
+    def _fenced_code_block_token_sub(self, match):
+        html = self._fenced_code_block_sub(match)
+        key = self._placeholder(html)
+        self._block_html[key] = _BlockHtml(html.strip("\n"))
+        return "\n\n" + key + "\n\n"
+
+    def _block_tokens(self, text):
+        """Return the HTML of the blocks of `text`: what
+        `_run_block_gamut()` splits into paragraphs and blocks.
+        """
+        if "fenced-code-blocks" in self.extras:
+            text = self._fenced_code_block_re.sub(
+                self._fenced_code_block_token_sub, text)
+        if self._html_line_re.search(text):
+            raise _Unsupported("HTML block")
+        block_html = self._block_html
+        lines = [block_html.get(line, line) for line in text.split("\n")]
+        for step in (self._header_and_hr_lines, self._list_lines,
+                     self._code_block_lines, self._block_quote_lines):
+            self._check_time_budget()
+            lines = step(lines)
+        return self._paragraph_blocks(lines)
+
+    _setext_underline_re = re.compile(r"(=+|-+)[ \t]*$")
+
+    def _header_and_hr_lines(self, lines):
+        # `_do_headers()` then `_do_horizontal_rules()`: a header takes
+        # the blank lines after it, a rule is put between blank lines.
+        hr = _BlockHtml("<hr" + self.empty_element_suffix)
+        out = []
+        i, n = 0, len(lines)
+        while i < n:
+            line = lines[i]
+            i += 1
+            if not line or isinstance(line, _BlockHtml):
+                out.append(line)
+                continue
+            match = None
+            next = lines[i] if i < n else ""
+            if (next[:1] in ("=", "-") and not isinstance(next, _BlockHtml)
+                    and self._setext_underline_re.match(next)):
+                match = self._h_re.match(line + "\n" + next + "\n")
+                i += 1
+            elif line[0] == "#":
+                match = self._h_re.match(line + "\n")
+            if match:
+                out.append(_BlockHtml(self._h_sub(match).rstrip("\n")))
+                out.append("")
+                while i < n and lines[i] == "":
+                    i += 1
+            elif line[0] in "-_* " and self._hr_re.match(line):
+                out.extend(("", hr, ""))
+            else:
+                out.append(line)
+        return out
+
+    _list_start_res = [
+        re.compile(r"[ ]{0,3}(%s)[ \t]+(?!\ *\1\ )" % marker)
+        for marker in (r"[*+-]", r"\d+\.")]
+    _list_more_res = [re.compile(r"[ \t]*%s[ \t]+" % marker)
+                      for marker in (r"[*+-]", r"\d+\.")]
+    _list_marker_re = re.compile(r"([ ]*)(?:[*+-]|\d+\.)[ \t]+")
+    _sub_list_re = re.compile(r"^[ ]{0,3}(?:[*+-]|\d+\.)[ \t]", re.M)
+
+    def _list_lines(self, lines):
+        # `_do_lists()` for the lists without sub-lists: after a blank
+        # line, up to a blank line followed by a line that isn't indented
+        # and doesn't have the same kind of marker.
+        out = []
+        i, n = 0, len(lines)
+        while i < n:
+            line = lines[i]
+            if (line and (i == 0 or lines[i - 1] == "")
+                    and not isinstance(line, _BlockHtml)):
+                for style in (0, 1):
+                    if self._list_start_res[style].match(line):
+                        break
+                else:
+                    style = None
+                if style is not None:
+                    more_re = self._list_more_res[style]
+                    j = i
+                    while True:
+                        while j < n and lines[j] != "":
+                            j += 1
+                        k = j
+                        while k < n and lines[k] == "":
+                            k += 1
+                        if (k == n or isinstance(lines[k], _BlockHtml)
+                                or lines[k][0] != " "
+                                and not more_re.match(lines[k])):
+                            break
+                        j = k
+                    out.append(self._list_html(lines[i:j], style))
+                    out.append("")
+                    i = k
+                    continue
+            out.append(line)
+            i += 1
+        return out
+
+    def _list_html(self, lines, style):
+        # `_process_list_items()`: an item goes up to the next line with a
+        # marker indented like the first one. An item with a blank line
+        # in it, after it or before it is converted as blocks. Lists with
+        # sub-lists, empty items or a header inside are left to
+        # `_process_list_items()` itself.
+        tag = ("ul", "ol")[style]
+        items = []
+        indent = None
+        for line in lines:
+            match = self._list_marker_re.match(line)
+            if match and match.end() == len(line) and indent is None:
+                # `_list_re` makes the list take in the next paragraph.
+                raise _Unsupported("empty list item")
+            if (isinstance(line, _BlockHtml)
+                    or match and match.end() == len(line)):
+                items = None
+                break
+            if match and (indent is None or match.group(1) == indent):
+                indent = match.group(1)
+                items.append([line[match.end():]])
+            else:
+                items[-1].append(self._outdent(line))
+        if items is not None:
+            for item in items:
+                blanks = 0
+                while item[-1] == "":
+                    item.pop()
+                    blanks += 1
+                item[:] = ["\n".join(item), blanks]
+                if self._sub_list_re.search(item[0]):
+                    items = None
+                    break
+        if items is None:
+            html = "\n".join(lines)
+            if self._nested_html_line_re.search(html):
+                raise _Unsupported("HTML block")
+            html = self._process_list_items(html)
+            if re.search(r"^</%s>[ \t]*$" % tag, html, re.M):
+                # `_hash_html_blocks()` would end the list there.
+                raise _Unsupported("sub-list closing the list")
+            return _BlockHtml("<%s>\n%s</%s>" % (tag, html, tag))
+        html = []
+        blanks_before = 0
+        for item, blanks in items:
+            if blanks_before or blanks or "\n\n" in item:
+                item = "\n\n".join(self._block_tokens(
+                    item + ("\n\n" if blanks else "\n")))
+            else:
+                item = self._run_span_gamut(item)
+            html.append("<li>%s</li>\n" % item)
+            blanks_before = blanks
+        return _BlockHtml("<%s>\n%s</%s>" % (tag, "".join(html), tag))
+
+    def _code_block_lines(self, lines):
+        # `_do_code_blocks()`: indented lines and the blank lines between
+        # them, after a blank line.
+        out = []
+        i, n = 0, len(lines)
+        while i < n:
+            line = lines[i]
+            if (line.startswith("    ") and (i == 0 or lines[i - 1] == "")
+                    and not isinstance(line, _BlockHtml)):
+                j = end = i
+                while j < n and (lines[j] == "" or
+                        (lines[j].startswith("    ")
+                         and not isinstance(lines[j], _BlockHtml))):
+                    j += 1
+                    if lines[j - 1]:
+                        end = j
+                codeblock = "\n".join(
+                    [line[4:] for line in lines[i:end]]).rstrip()
+                out.append(_BlockHtml("<pre><code>%s\n</code></pre>"
+                                      % self._encode_code(codeblock)))
+                out.append("")
+                i = j
+                continue
+            out.append(line)
+            i += 1
+        return out
+
+    _block_quote_start_re = re.compile(r"[ \t]*>[ \t]?.")
+
+    def _block_quote_lines(self, lines):
+        # `_do_block_quotes()`: lines starting with ">", the lines after
+        # them up to a blank line, and more of those after blank lines.
+        out = []
+        i, n = 0, len(lines)
+        while i < n:
+            line = lines[i]
+            if (line and not isinstance(line, _BlockHtml)
+                    and self._block_quote_start_re.match(line)):
+                j = i
+                while j < n and not isinstance(lines[j], _BlockHtml) and (
+                        self._block_quote_start_re.match(lines[j])):
+                    while j < n and lines[j] != "":
+                        j += 1
+                    while j < n and lines[j] == "":
+                        j += 1
+                out.append(self._block_quote_html(lines[i:j]))
+                out.append("")
+                i = j
+                continue
+            out.append(line)
+            i += 1
+        return out
+
+    _nested_block_quote_re = re.compile(r"^[ \t]*>", re.M)
+
+    def _block_quote_html(self, lines):
+        # `_block_quote_sub()`; nested blockquotes and headers inside go
+        # through `_run_block_gamut()` as they would there.
+        bq = "\n".join(lines) + "\n"
+        bq = self._bq_one_level_re.sub('', bq)
+        bq = self._ws_only_line_re.sub('', bq)
+        if (self._nested_block_quote_re.search(bq)
+                or any(isinstance(l, _BlockHtml) for l in lines)):
+            if self._nested_html_line_re.search(bq):
+                raise _Unsupported("HTML block")
+            bq = self._run_block_gamut(bq)
+        else:
+            bq = "\n\n".join(self._block_tokens(bq))
+        bq = re.sub('(?m)^', '  ', bq)
+        bq = self._html_pre_block_re.sub(self._dedent_two_spaces_sub, bq)
+        return _BlockHtml("<blockquote>\n%s\n</blockquote>" % bq)
+
+    def _paragraph_blocks(self, lines):
+        # `_form_paragraphs()`: a rendered block is one by itself, the
+        # other lines make paragraphs.
+        blocks = []
+        graf = []
+        for line in lines:
+            if line and not isinstance(line, _BlockHtml):
+                graf.append(line)
+                continue
+            if graf:
+                blocks.append("<p>%s</p>" % self._run_span_gamut(
+                    "\n".join(graf)).lstrip(" \t"))
+                graf = []
+            if line:
+                blocks.append(line)
+        if graf:
+            blocks.append("<p>%s</p>" % self._run_span_gamut(
+                "\n".join(graf)).lstrip(" \t"))
+        return blocks or ["<p></p>"]
+
+    _span_token_re = re.compile(r'''
+        (?<!\\)(`+)(?!`)(.+?)(?<!`)\1(?!`)  # \1, \2: code span, see `_code_span_re`
+        |
+        \\([\\`*_{}\[\]()>\#+\-.!])         # \3: backslash escape
+        |
+        ([<\\])                             # \4: a tag or a literal backslash
+        ''', re.X | re.S)
+    _tag_start_re = re.compile(r"[\w/!?]")
+
+    def _run_span_gamut(self, text):
+        if not self._tokenizing:
+            return Markdown._run_span_gamut(self, text)
+        self._check_time_budget()
+
+        # Code spans, backslash escapes and tags in one scan, leaving the
+        # text as `_do_code_spans()` and `_escape_special_chars()` do.
+        pieces = []
+        pos = 0
+        tags = backslash = False
+        # As in `_sorta_html_tokenize()`, tags are only looked for up to
+        # the last '>'; the next backtick is kept rather than looked up
+        # again for each '<'.
+        last_gt = text.rfind(">") + 1
+        backtick = text.find("`")
+        match = self._span_token_re.search(text)
+        while match:
+            end = match.end()
+            if match.group(1):
+                pieces.append(text[pos:match.start()])
+                pieces.append("<code>%s</code>" % self._encode_code(
+                    match.group(2).strip(" \t")))
+                pos = end
+            elif match.group(3):
+                pieces.append(text[pos:match.start()])
+                pieces.append(self._escape_table[match.group(3)])
+                pos = end
+            elif match.group(4) == "\\":
+                backslash = True
+            else:
+                if not self._tag_start_re.match(text, end):
+                    match = self._span_token_re.search(text, end)
+                    continue
+                # `Markdown` finds the tags after the code spans: one of
+                # those after the "<" could be in the tag, or end it.
+                tag = self._sorta_html_tokenize_re.match(
+                    text, match.start(), last_gt)
+                if -1 < backtick < end:
+                    backtick = text.find("`", end)
+                if backtick != -1 and (not tag or tag.end() > backtick):
+                    raise _Unsupported("code span in a tag")
+                if tag:
+                    tag = tag.group(0)
+                    # E-mail addresses are encoded at random.
+                    if self._auto_email_link_re.search(tag):
+                        raise _Unsupported("e-mail address")
+                    pieces.append(text[pos:match.start()])
+                    pieces.append(tag.replace('*', self._escape_table['*'])
+                                     .replace('_', self._escape_table['_']))
+                    pos = end = match.start() + len(tag)
+                    tags = True
+            match = self._span_token_re.search(text, end)
+        if backslash:
+            self._backslash_texts.append(text)
+        if pos:
+            pieces.append(text[pos:])
+            text = "".join(pieces)
+
+        if "[" in text:
+            text = self._do_links(text)
+        if tags:
+            text = self._auto_link_re.sub(self._auto_link_sub, text)
+        if "&" in text:
+            text = self._ampersand_re.sub('&amp;', text)
+        if "<" in text:
+            text = self._naked_lt_re.sub('&lt;', text)
+        if ">" in text:
+            text = self._naked_gt_re.sub('&gt;', text)
+        if "*" in text or "_" in text:
+            text = self._do_italics_and_bold(text)
+        if "  \n" in text:
+            text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix,
+                          text)
+        return text
+
+
+# The converters `markdown()` and `markdown_many()` can use.
+_engines = {"regex": Markdown, "tokenizer": TokenizerMarkdown}
+
+def _engine_class(engine):
+    try:
+        return _engines[engine]
+    except KeyError:
+        raise MarkdownError("invalid markdown engine: %r (must be one of %s)"
+                            % (engine, ", ".join(sorted(_engines))))
+
+
 #---- internal support functions
 
+# Pygments lexers and formatters are looked up once and shared by all
+# `Markdown` instances, and highlighted code blocks are cached: finding
+# a lexer by name scans the installed lexers, and highlighting is the
+# most expensive part of rendering a code-heavy document.
+_pygments_lexers = {}
+_pygments_formatters = {}
+_pygments_lock = threading.Lock()
+_HtmlCodeFormatter = None
+_highlighted_blocks = BlockCache(1000)
+
+def _get_pygments_lexer(lexer_name):
+    try:
+        return _pygments_lexers[lexer_name]
+    except KeyError:
+        pass
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        lexer = lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        lexer = None
+    _pygments_lexers[lexer_name] = lexer
+    return lexer
+
+def _get_pygments_formatter(formatter_opts):
+    global _HtmlCodeFormatter
+    key = repr(sorted(formatter_opts.items()))
+    formatter = _pygments_formatters.get(key)
+    if formatter is not None:
+        return formatter
+    with _pygments_lock:
+        if _HtmlCodeFormatter is None:
+            import pygments.formatters
+
+            class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+                def _wrap_code(self, inner):
+                    """A function for use in a Pygments Formatter which
+                    wraps in <code> tags.
+                    """
+                    yield 0, "<code>"
+                    for tup in inner:
+                        yield tup
+                    yield 0, "</code>"
+
+                def wrap(self, source, outfile=None):
+                    """Return the source with a code, pre, and div."""
+                    if outfile is None:
+                        # pygments >= 2.12 wraps the div itself
+                        return self._wrap_pre(self._wrap_code(source))
+                    return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+            _HtmlCodeFormatter = HtmlCodeFormatter
+        formatter = _pygments_formatters[key] = _HtmlCodeFormatter(**formatter_opts)
+    return formatter
+
+def _color_with_pygments(codeblock, lexer, formatter_opts):
+    key = (type(lexer), repr(sorted(lexer.options.items())),
+           repr(sorted(formatter_opts.items())), codeblock)
+    colored = _highlighted_blocks.get(key)
+    if colored is None:
+        import pygments
+        colored = pygments.highlight(codeblock, lexer,
+                                     _get_pygments_formatter(formatter_opts))
+        _highlighted_blocks[key] = colored
+    return colored
+
+
+def _sub_delimited(regex, repl, text, open_re, last_close):
+    """Return `regex.sub(repl, text)`, for a function `repl` and a `regex`
+    that matches from an opening delimiter up to the nearest closing one.
+
+    `open_re` finds where the opening delimiters can be, with the
+    delimiter in group 1, and `last_close` maps each delimiter to where
+    its last closing occurrence starts. `regex.sub()` tries every opening
+    delimiter, and when there is no closing one after it each try runs to
+    the end of the text. Here those aren't tried.
+    """
+    if not last_close:
+        return text
+    pieces = []
+    pos = 0
+    for opening in open_re.finditer(text):
+        start = opening.start()
+        if start < pos or last_close.get(opening.group(1), -1) <= start:
+            continue
+        match = regex.match(text, start)
+        if match is None:
+            continue
+        pieces.append(text[pos:start])
+        pieces.append(repl(match))
+        pos = match.end()
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+def _last_group_starts(regex, text):
+    """Map each value of group 1 of `regex` to where its last match in
+    `text` starts.
+    """
+    starts = {}
+    for match in regex.finditer(text):
+        starts[match.group(1)] = match.start()
+    return starts
+
+
+class _BalanceIndex(object):
+    """Where brackets balance out in a text, for `Markdown._do_links()`.
+
+    For each pair of open/close characters the closing characters are
+    indexed by their nesting depth once, so finding the one that balances
+    an opening character is a bisection instead of a scan.
+    """
+    # Brackets scanned before falling back to the index: enough for
+    # most links, which are short and not nested.
+    SCAN_LIMIT = 8
+
+    _pair_res = {}
+
+    def __init__(self, text):
+        self.text = text
+        self._tables = {}
+
+    def _pair_re(self, open_c, close_c):
+        pair_re = self._pair_res.get(open_c)
+        if pair_re is None:
+            pair_re = self._pair_res[open_c] = re.compile(
+                "[%s]" % re.escape(open_c + close_c))
+        return pair_re
+
+    def _table(self, open_c, close_c):
+        table = self._tables.get(open_c)
+        if table is None:
+            positions, depths, closes = [], [], {}
+            depth = 0
+            for match in self._pair_re(open_c, close_c).finditer(self.text):
+                positions.append(match.start())
+                depths.append(depth)
+                if match.group() == open_c:
+                    depth += 1
+                else:
+                    closes.setdefault(depth, []).append(match.start())
+                    depth -= 1
+            table = self._tables[open_c] = (positions, depths, depth, closes)
+        return table
+
+    def find(self, open_c, close_c, start, end):
+        """Return the index of the first `close_c` from `start` that
+        isn't matched by an `open_c` from `start` -- i.e. the one that
+        balances an `open_c` right before `start` -- or -1 if there is
+        none before `end`.
+        """
+        depth = 0
+        scanned = 0
+        for match in self._pair_re(open_c, close_c).finditer(self.text,
+                                                             start, end):
+            if match.group() == open_c:
+                depth += 1
+            elif depth:
+                depth -= 1
+            else:
+                return match.start()
+            scanned += 1
+            if scanned == self.SCAN_LIMIT:
+                break
+        else:
+            return -1
+
+        positions, depths, last_depth, closes = self._table(open_c, close_c)
+        i = bisect_left(positions, start)
+        depth = depths[i] if i < len(positions) else last_depth
+        candidates = closes.get(depth)
+        if candidates:
+            i = bisect_left(candidates, start)
+            if i < len(candidates) and candidates[i] < end:
+                return candidates[i]
+        return -1
+
+
+class _RecordingDict(dict):
+    """A dict that also records every item set on it, in order."""
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.recorded = []
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.recorded.append((key, value))
+
+class _Placeholders(object):
+    """The placeholders of one document: one per distinct text, made of
+    a nonce of the document and a counter. The nonce is a hash of the
+    document `text`, or random if there isn't one.
+
+    Texts that already have a placeholder in `escape_table` -- the
+    escaped characters -- keep it, as they did when placeholders were
+    hashes of the text.
+    """
+    def __init__(self, escape_table, text=None):
+        if text is None:
+            self.nonce = _new_nonce()
+        else:
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            self.nonce = md5(text).hexdigest()[:16]
+        self.keys = dict(escape_table)
+    def __call__(self, s):
+        key = self.keys.get(s)
+        if key is None:
+            key = self.keys[s] = "md5-%s%016x" % (self.nonce, len(self.keys))
+        return key
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
@@ -1997,6 +3174,9 @@ class UnicodeWithAttrs(unicode):
     """
     metadata = None
     _toc = None
+    # True if the text couldn't be converted within the time budget or
+    # nesting limit and was only escaped.
+    fallback = False
     def toc_html(self):
         """Return the HTML for the current TOC.
         This expects the `_toc` attribute to have been set on this instance.
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''进程内的运行指标，以Prometheus文本格式输出
+
+Counter为只增不减的计数，Gauge为可增可减的当前值，Histogram按桶统计分布，如请求耗时
+每个指标可以带若干标签，记录时按标签值分别统计'''
+
+import bisect
+
+#默认的耗时分桶，单位为秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#转义标签值中的\, "和换行
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    '''
+    >>> _labels(('route', 'method'), ('/api/blogs', 'GET'))
+    '{route="/api/blogs",method="GET"}'
+    >>> _labels((), (), 'le="0.5"')
+    '{le="0.5"}'
+    >>> _labels((), ())
+    ''
+    '''
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+#指标基类，values以标签值的元组为键
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def collect(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for labels in sorted(self.values):
+            lines.extend(self.samples(labels))
+        return lines
+
+    def samples(self, labels):
+        return ['%s%s %s' % (self.name, _labels(self.labelnames, labels), _format_value(self.values[labels]))]
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+#values中每个标签对应[各桶计数, 总和, 总数]，桶计数不累加，输出时再累加成Prometheus要求的格式
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    def samples(self, labels):
+        counts, total, count = self.values[labels]
+        lines, acc = [], 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            acc += n
+            lines.append('%s_bucket%s %s' % (self.name, _labels(self.labelnames, labels, 'le="%s"' % _format_value(bound)), acc))
+        lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, _labels(self.labelnames, labels), count))
+        return lines
+
+#所有指标按注册顺序输出
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    #以Prometheus文本格式输出全部指标
+    def exposition(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.collect())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+#————————————————Web App的指标————————————————
+
+#请求按URL处理函数的路由模式(__route__)统计，如/blog/{id}，不按实际路径统计，以免标签值无限增长
+REQUEST_LATENCY = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency.', ('route', 'method'))
+REQUEST_TOTAL = REGISTRY.counter('http_requests_total', 'HTTP requests by status code.', ('route', 'method', 'status'))
+REQUESTS_IN_PROGRESS = REGISTRY.gauge('http_requests_in_progress', 'HTTP requests being handled.')
+REQUEST_QUERIES = REGISTRY.histogram('http_request_db_queries', 'SQL statements executed per HTTP request.', ('route',), (0, 1, 2, 3, 5, 10, 20, 50, 100))
+RENDER_TIME = REGISTRY.histogram('template_render_seconds', 'Jinja2 template render time.', ('template',))
+
+#Markdown渲染服务的指标，route为cache(缓存命中), inline(当前线程), process(进程池), overflow(队列已满，等待超时未渲染), timeout, batch(rebuild批量渲染)
+MARKDOWN_RENDERS = REGISTRY.counter('markdown_renders_total', 'Markdown renders by route.', ('route',))
+MARKDOWN_RENDER_TIME = REGISTRY.histogram('markdown_render_seconds', 'Markdown render time, including process pool queueing.', ('route',))
+MARKDOWN_RENDER_PENDING = REGISTRY.gauge('markdown_render_pending', 'Markdown renders queued or running in the process pool.')
+#超出渲染时间预算或嵌套过深，退回为转义后的纯文本的渲染
+MARKDOWN_RENDER_FALLBACKS = REGISTRY.counter('markdown_render_fallbacks_total', 'Markdown renders that exceeded the time budget and fell back to escaped text.', ('route',))
+#渲染结果缓存的查找，result为memory, disk或miss
+RENDER_CACHE_LOOKUPS = REGISTRY.counter('markdown_render_cache_lookups_total', 'Markdown render cache lookups by result.', ('result',))
+
+#————————————————日志————————————————
+
+#日志队列已满时丢弃的日志数
+LOG_RECORDS_DROPPED = REGISTRY.counter('log_records_dropped_total', 'Log records dropped because the log queue was full.')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''数据库结构变更，按顺序执行尚未执行过的迁移'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import asyncio
+
+import orm
+
+from config import configs
+
+from plaintext import text2html
+
+#已执行的迁移记录在schema_migrations表中
+_CREATE_MIGRATIONS_TABLE = 'create table if not exists `schema_migrations` (`name` varchar(100) not null, `applied_at` real not null, primary key (`name`)) engine=innodb default charset=utf8'
+
+#为已有评论批量生成html_content，每批用一条UPDATE ... CASE语句写回
+#按主键顺序分批，每批从上一批的最后一个id之后开始，html_content没有索引，不能每批都从头查找
+@asyncio.coroutine
+def backfill_comment_html(batch=500):
+    total, last_id = 0, ''
+    while True:
+        rs = yield from orm.select('select `id`, ifnull(`content`, \'\') `content` from `comments` where `id` > ? and `html_content` is null order by `id` limit ?', [last_id, batch])
+        if not rs:
+            break
+        last_id = rs[-1]['id']
+        args = []
+        for r in rs:
+            args.extend([r['id'], text2html(r['content'])])
+        args.extend([r['id'] for r in rs])
+        sql = 'update `comments` set `html_content` = case `id` %s end where `id` in (%s)' % (' '.join(['when ? then ?'] * len(rs)), orm.create_args_string(len(rs)))
+        yield from orm.execute(sql, args)
+        total += len(rs)
+        logging.info('backfill comment html: %s comments' % total)
+
+#每个迁移由名称和若干步骤组成，步骤为SQL语句，或需要执行Python代码时为无参数的协程函数
+#新的迁移只能追加在末尾，已发布的迁移不要再修改
+MIGRATIONS = [
+    ('0001_blog_comment_count', [
+        'alter table `blogs` add column `comment_count` bigint not null default 0',
+        'update `blogs` b set b.`comment_count` = (select count(c.`id`) from `comments` c where c.`blog_id` = b.`id`)'
+    ]),
+    #博客详情页按(created_at, id)游标翻页，InnoDB二级索引自带主键，可覆盖排序
+    ('0002_comments_blog_id_created_at', [
+        'create index `idx_blog_id_created_at` on `comments` (`blog_id`, `created_at`)'
+    ]),
+    ('0003_comment_html_content', [
+        'alter table `comments` add column `html_content` text',
+        backfill_comment_html
+    ]),
+    ('0004_blog_updated_at', [
+        'alter table `blogs` add column `updated_at` real not null default 0',
+        'update `blogs` b set b.`updated_at` = greatest(b.`created_at`, ifnull((select max(c.`created_at`) from `comments` c where c.`blog_id` = b.`id`), 0))'
+    ]),
+]
+
+@asyncio.coroutine
+def migrate():
+    yield from orm.execute(_CREATE_MIGRATIONS_TABLE, [])
+    rs = yield from orm.select('select `name` from `schema_migrations`', [])
+    applied = set(r['name'] for r in rs)
+    for name, steps in MIGRATIONS:
+        if name in applied:
+            continue
+        logging.info('apply migration %s...' % name)
+        for step in steps:
+            if callable(step):
+                yield from step()
+            else:
+                yield from orm.execute(step, [])
+        yield from orm.execute('insert into `schema_migrations` (`name`, `applied_at`) values (?, unix_timestamp())', [name])
+
+@asyncio.coroutine
+def main(loop):
+    yield from orm.create_pool(loop=loop, **configs.db)
+    yield from migrate()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
@@ -5,7 +5,7 @@
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField
 
 #用当前时间戳与由伪随机数得到的UUID结合生成唯一id，做为数据库表中的主键
 #python的时间戳是浮点数，需乘以1000转化成整数
@@ -19,7 +19,7 @@ class User(Model):
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
-    passwd = StringField(ddl='varchar(50)')
+    passwd = StringField(ddl='varchar(50)', masked=True)
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
@@ -35,7 +35,11 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    #评论数，由创建/删除评论的接口在同一事务中维护，jobs.reconcile_comment_counts()定期校正
+    comment_count = IntegerField(counter=True)
     created_at = FloatField(default=time.time)
+    #博客内容或评论发生变化的时间，用作ETag和Last-Modified
+    updated_at = FloatField(default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
@@ -46,4 +50,6 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
+    #由plaintext.text2html()在保存时生成的html，浏览时不再重复转换
+    html_content = TextField()
     created_at = FloatField(default=time.time)
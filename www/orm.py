@@ -3,18 +3,24 @@
 
 '''ORM，对象关系映射，将关系数据库的一行映射为一个对象,即一个类对应一个表'''
 
-import asyncio, logging
+import asyncio, logging, weakref
 
 import aiomysql
 
+logger = logging.getLogger(__name__)
+
+#每条SQL语句执行前调用，同时累计当前请求执行的语句数
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logger.info('SQL: %s', sql)
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.queries += 1
 
 #创建全局连接池，每个HTTP请求都能从连接池中直接获取数据库连接
 #避免了频繁地打开或关闭数据库连接
 @asyncio.coroutine
 def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
+    logger.info('create database connection pool...')
     #连接池储存于全局变量__pool中
     global __pool
     __pool = yield from aiomysql.create_pool(
@@ -61,7 +67,7 @@ def select(sql, args, size=None):
         else:
             rs = yield from cur.fetchall()
         yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
+        logger.info('rows returned: %s', len(rs))
         return rs
 
 #execute函数，用于执行INSERT, UPDATE, DELETE语句，三者所需参数相同
@@ -88,6 +94,89 @@ def execute(sql, args, autocommit=True):
             raise
         return affected
 
+#在同一个连接上用一个事务依次执行多条INSERT, UPDATE, DELETE语句
+#statements为(sql, args)组成的列表，任一条出错则全部回滚，返回每条语句影响的行数
+#列表中也可以是函数，以之前各语句影响的行数列表为参数，返回(sql, args)，返回None时跳过该语句，影响行数记为0
+#如删除评论后，只有确实删除了一行才将评论数减1
+@asyncio.coroutine
+def transaction(statements):
+    with (yield from __pool) as conn:
+        yield from conn.begin()
+        try:
+            cur = yield from conn.cursor()
+            affected = []
+            for statement in statements:
+                if callable(statement):
+                    statement = statement(affected)
+                    if statement is None:
+                        affected.append(0)
+                        continue
+                sql, args = statement
+                log(sql)
+                yield from cur.execute(sql.replace('?', '%s'), args)
+                affected.append(cur.rowcount)
+            yield from cur.close()
+            yield from conn.commit()
+        except BaseException as e:
+            yield from conn.rollback()
+            raise
+        return affected
+
+#以流的方式分批读取SELECT语句的结果，使用服务端游标SSDictCursor，结果不会一次性全部加载到内存
+#第一次调用fetch()时才从连接池获取连接并执行查询，读完或调用close()后归还连接
+class ModelStream(object):
+
+    def __init__(self, cls, sql, args=None, batch_size=500):
+        self.cls = cls
+        self.sql = sql
+        self.args = args
+        self.batch_size = batch_size
+        self._conn = None
+        self._cur = None
+        self._closed = False
+
+    #读取下一批结果，返回Model实例的列表，全部读完后返回空列表
+    @asyncio.coroutine
+    def fetch(self):
+        if self._closed:
+            return []
+        try:
+            if self._conn is None:
+                log(self.sql, self.args)
+                self._conn = yield from _acquire()
+                self._cur = yield from self._conn.cursor(aiomysql.SSDictCursor)
+                yield from self._cur.execute(self.sql.replace('?', '%s'), self.args or ())
+            rs = yield from self._cur.fetchmany(self.batch_size)
+        except BaseException:
+            self.close()
+            raise
+        if not rs:
+            #结果已读完，关闭游标后连接可以直接复用
+            yield from self._cur.close()
+            self._cur = None
+            self.close()
+            return []
+        return [self.cls(**r) for r in rs]
+
+    #归还连接，若结果尚未读完(如客户端中途断开)，直接关闭连接，避免读取剩余的行
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._conn is not None:
+            if self._cur is not None:
+                self._conn.close()
+            _release(self._conn)
+            self._conn = self._cur = None
+
+#从连接池获取连接，由ModelStream使用，需在使用完毕后调用_release()归还
+@asyncio.coroutine
+def _acquire():
+    return (yield from __pool.acquire())
+
+def _release(conn):
+    __pool.release(conn)
+
 #在INSERT语句中被调用，作用是构造出与需要插入的数据数量相等的占位符
 def create_args_string(num):
     L = []
@@ -95,14 +184,82 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+#获取当前正在运行的Task，asyncio.current_task()在Python3.7中才加入
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except AttributeError:
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        #不在事件循环中调用时没有当前Task
+        return None
+
+#请求级的工作单元(Unit of Work)，内部维护一个Identity Map
+#同一个请求内，按(Model类, 主键)记录已加载的实例，再次find时直接返回，不再查询数据库
+#工作单元随请求创建，请求结束即丢弃，因此不会出现跨请求的脏数据
+class UnitOfWork(object):
+
+    def __init__(self):
+        self._identity_map = dict()
+        #本请求执行的SQL语句数
+        self.queries = 0
+
+    def get(self, cls, pk):
+        return self._identity_map.get((cls, pk))
+
+    #登记实例，若同一主键已有实例，返回已有的实例以保证同一请求内对象唯一
+    def register(self, obj):
+        key = (obj.__class__, obj.getValue(obj.__primary_key__))
+        return self._identity_map.setdefault(key, obj)
+
+    def discard(self, obj):
+        self._identity_map.pop((obj.__class__, obj.getValue(obj.__primary_key__)), None)
+
+    def clear(self):
+        self._identity_map.clear()
+
+    def __len__(self):
+        return len(self._identity_map)
+
+#以Task为键保存工作单元，Task结束后自动回收
+_units_of_work = weakref.WeakKeyDictionary()
+
+#将工作单元绑定到当前Task，由middleware在处理请求前调用
+def begin_unit_of_work(uow=None):
+    task = _current_task()
+    if uow is None:
+        uow = UnitOfWork()
+    if task is not None:
+        _units_of_work[task] = uow
+    return uow
+
+#请求处理结束后解除绑定并丢弃工作单元
+def end_unit_of_work():
+    task = _current_task()
+    if task is not None:
+        uow = _units_of_work.pop(task, None)
+        if uow is not None:
+            uow.clear()
+
+#获取当前Task的工作单元，不在请求中时返回None，此时Model的行为与原来一致
+def current_unit_of_work():
+    task = _current_task()
+    if task is None:
+        return None
+    return _units_of_work.get(task)
+
 #Field类，负责保存数据库表的字段名和字段类型
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, masked=False, counter=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        #序列化为JSON时是否屏蔽该字段的值，如用户密码
+        self.masked = masked
+        #是否为只通过incrStatement()原子加减的计数字段，如评论数，update()不会写回它
+        self.counter = counter
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -112,13 +269,13 @@ class StringField(Field):
     #ddl("data definition languages"),用于定义数据类型
     #varchar, 可变长度字符串,此处字符串的可变范围为0~100
     #char,固定长度字符串,长度不够会用空格字符补齐)
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', masked=False):
+        super().__init__(name, ddl, primary_key, default, masked)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, counter=False):
+        super().__init__(name, 'bigint', primary_key, default, counter=counter)
 
 class BooleanField(Field):
 
@@ -147,14 +304,14 @@ class ModelMetaclass(type):
             return type.__new__(cls, name, bases, attrs)
         #获取数据库表名，若当前类中未定义__table__属性，则将类名作为表名
         tableName = attrs.get('__table__', None) or name
-        logging.info('found model: %s (table: %s)' % (name, tableName))
+        logger.info('found model: %s (table: %s)', name, tableName)
         mappings = dict()    #创建字典，用于储存类属性与数据库表中列的映射关系
         fields = []    #储存除主键外的属性
         primaryKey = None    #储存主键属性
         #历遍类属性，若其值为Field类型，将其存入映射关系字典中，建立映射关系
         for k, v in attrs.items():
             if isinstance(v, Field):
-                logging.info('  found mapping: %s ==> %s' % (k, v))
+                logger.info('  found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 #若v是主键，判断primaryKey值是否存在
                 if v.primary_key:
@@ -177,10 +334,12 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName    #存入表名
         attrs['__primary_key__'] = primaryKey    #存入主键属性名
         attrs['__fields__'] = fields    #存入除主键外的属性名
+        attrs['__masked_fields__'] = [k for k, v in mappings.items() if v.masked]    #存入序列化时需屏蔽的属性名
+        attrs['__update_fields__'] = [f for f in fields if not mappings[f].counter]    #存入update()默认更新的属性名，不含计数字段
         #构造默认的SELECT, INSERT, UPDATE和DELETE语句，存入类属性中
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f:'`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f:'`%s`=?' % (mappings.get(f).name or f), attrs['__update_fields__'])), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
         #要得到当前类的实例，应当在当前类中的__new__()方法语句中调用当前类的父类的__new__()方法
         return type.__new__(cls, name, bases, attrs)
@@ -220,18 +379,29 @@ class Model(dict, metaclass=ModelMetaclass):
             #若默认值存在，判断其是否可调用，若可调用则将其返回值赋给value，否则直接赋给value
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s: %s' % (key, str(value)))
+                logger.debug('using default value for %s: %s', key, value)
                 #将value设置为当前属性的值
                 setattr(self, key, value)
         return value
 
     #@classmethod是一个装饰器，用来指定一个类的方法为类方法
     #类方法既可以直接类调用(C.f())，也可以进行实例调用(C().f())
+    #只查询fields中字段的SELECT语句，主键总会被查询，fields为空时查询全部字段
     @classmethod
-    #对默认SELECT语句的补充，可实现根据WHERE条件查找
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
+    def selectStatement(cls, fields=None):
+        if not fields:
+            return cls.__select__
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        columns = [cls.__primary_key__] + [f for f in cls.__fields__ if f in fields]
+        return 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, columns)), cls.__table__)
+
+    #对默认SELECT语句的补充，根据WHERE, ORDER BY, LIMIT条件构造SELECT语句及其参数
+    #fields参数可指定只查询部分字段，结果只包含这些字段
+    @classmethod
+    def selectQuery(cls, where=None, args=None, **kw):
+        sql = [cls.selectStatement(kw.get('fields', None))]
         #若有where子句，将'where'字符串和where参数加入SELECT语句
         if where:
             sql.append('where')
@@ -256,9 +426,29 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
+        return ' '.join(sql), args
+
+    #实现根据WHERE条件查找，参数同selectQuery()
+    @classmethod
+    @asyncio.coroutine
+    def findAll(cls, where=None, args=None, **kw):
+        fields = kw.get('fields', None)
+        sql, args = cls.selectQuery(where, args, **kw)
         #执行SELECT语句
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        rs = yield from select(sql, args)
+        uow = current_unit_of_work()
+        #只含部分字段的结果不登记到工作单元，以免其他查询拿到不完整的实例
+        if uow is None or fields:
+            return [cls(**r) for r in rs]
+        #在工作单元中登记查询结果，已加载过的行返回同一个实例
+        return [uow.register(cls(**r)) for r in rs]
+
+    #与findAll()相同，但返回ModelStream，以batch_size行为一批逐批读取，适合数据量很大的导出
+    #结果不登记到工作单元，内存占用与总行数无关
+    @classmethod
+    def findStream(cls, where=None, args=None, batch_size=500, **kw):
+        sql, args = cls.selectQuery(where, args, **kw)
+        return ModelStream(cls, sql, args, batch_size)
 
     #实现根据WHERE条件查找，但返回的是查询结果的数目，适用于SELECT COUNT(*)语句
     @classmethod
@@ -277,36 +467,94 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     @asyncio.coroutine
     def find(cls, pk):
+        #若当前请求已加载过该主键对应的行，直接返回已有实例
+        uow = current_unit_of_work()
+        if uow is not None:
+            obj = uow.get(cls, pk)
+            if obj is not None:
+                return obj
         rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        obj = cls(**rs[0])
+        if uow is not None:
+            obj = uow.register(obj)
+        return obj
 
-    #将实例的数据存入数据库
-    @asyncio.coroutine
-    def save(self):
+    #构造插入当前实例的INSERT语句及参数，可交给transaction()与其他语句一起执行
+    def insertStatement(self):
         #将除主键外的实例属性的值存入args列表
         args = list(map(self.getValueOrDefault, self.__fields__))
         #将主键的实例属性的值存入args列表
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__insert__, args)
+        return self.__insert__, args
+
+    #构造更新当前实例的UPDATE语句及参数，fields为需要更新的字段，为空时更新计数字段以外的全部字段
+    #只更新修改过的字段，其他请求同时修改的字段不会被旧值覆盖
+    def updateStatement(self, fields=None):
+        if not fields:
+            args = list(map(self.getValue, self.__update_fields__))
+            args.append(self.getValue(self.__primary_key__))
+            return self.__update__, args
+        for f in fields:
+            if f not in self.__fields__:
+                raise ValueError('Invalid field: %s' % f)
+        sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(['`%s`=?' % self.columnName(f) for f in fields]), self.__primary_key__)
+        return sql, [self.getValue(f) for f in fields] + [self.getValue(self.__primary_key__)]
+
+    #属性对应的列名，与默认的UPDATE语句相同，Field未指定name时列名即属性名
+    @classmethod
+    def columnName(cls, field):
+        return cls.__mappings__[field].name or field
+
+    #构造删除当前实例的DELETE语句及参数
+    def deleteStatement(self):
+        return self.__delete__, [self.getValue(self.__primary_key__)]
+
+    #构造对某一行的计数字段做原子加减的UPDATE语句及参数，如评论数
+    #values为需要同时更新的其他字段，如更新时间
+    @classmethod
+    def incrStatement(cls, pk, field, delta=1, **values):
+        for k in [field] + list(values.keys()):
+            if k not in cls.__fields__:
+                raise ValueError('Invalid field: %s' % k)
+        column = cls.columnName(field)
+        sets = ['`%s`=`%s`+?' % (column, column)] + ['`%s`=?' % cls.columnName(k) for k in values.keys()]
+        sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(sets), cls.__primary_key__)
+        return sql, [delta] + list(values.values()) + [pk]
+
+    #将实例的数据存入数据库
+    @asyncio.coroutine
+    def save(self):
+        sql, args = self.insertStatement()
+        rows = yield from execute(sql, args)
         #一个实例只能插入一行数据，若返回的影响行数不为1，报错
         if rows != 1:
-            logging.warn('failed to insert record: affected rows: %s' % rows)
+            logger.warning('failed to insert record: affected rows: %s', rows)
+        else:
+            uow = current_unit_of_work()
+            if uow is not None:
+                uow.register(self)
 
-    #数据的更新
+    #数据的更新，fields同updateStatement()
     @asyncio.coroutine
-    def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+    def update(self, fields=None):
+        sql, args = self.updateStatement(fields)
+        rows = yield from execute(sql, args)
         if rows != 1:
-            logging.warn('failed to update by primary key: affected rows: %s' % rows)
+            logger.warning('failed to update by primary key: affected rows: %s', rows)
 
     #数据的删除
     @asyncio.coroutine
     def remove(self):
-        args = [self.getValue(self.__primary_key__)]
-        rows = yield from execute(self.__delete__, args)
+        sql, args = self.deleteStatement()
+        rows = yield from execute(sql, args)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+            logger.warning('failed to remove by primary key: affected rows: %s', rows)
+        self.discard()
+
+    #从当前请求的工作单元中移除，删除后调用，避免同一请求内再次find到已删除的行
+    def discard(self):
+        uow = current_unit_of_work()
+        if uow is not None:
+            uow.discard(self)
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''纯文本转换为html，不依赖Web层，供handlers和migrations共用'''
+
+#将text格式转换成html格式，评论保存时调用一次，结果存入comments.html_content
+def text2html(text):
+    '''
+    >>> text2html('a < b & c > d\\n\\n  \\n第二行')
+    '<p>a &lt; b &amp; c &gt; d</p><p>第二行</p>'
+    >>> text2html('&amp; <b>\\r\\n\\t')
+    '<p>&amp;amp; &lt;b&gt;\\r</p>'
+    >>> text2html(' \\n\\n')
+    ''
+    '''
+    #先对整段文本转义，再一次遍历拆分出的行，过滤掉空白行并包上<p>标签
+    #转义不会改变空白字符，结果与逐行转义相同
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return ''.join(['<p>%s</p>' % s for s in text.split('\n') if s.strip()])
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Markdown渲染服务
+
+小于inline_size个字符的文本直接在当前线程渲染，较大的文本交给进程池，避免长时间阻塞事件循环
+进程池中等待和正在渲染的任务数不超过max_pending，超出时等待空位，timeout秒内没有空位时抛出RenderError
+超过timeout秒未完成时抛出RenderError，进程池无法中止单个任务，该进程会继续渲染直到完成，完成前仍占用一个空位
+子进程用forkserver方式启动，不继承父进程中的线程，如logconf的日志线程
+每篇文档的渲染时间不超过budget秒，超出或嵌套过深时退回为转义后的纯文本段落，这样的结果不缓存
+渲染结果按内容缓存在render_cache中，相同的文本不会重复渲染
+每个进程还按顶层块缓存渲染结果，修改长博客中的一处后只需重新渲染改动的块
+rebuild()在多个进程中批量渲染并写入缓存，用于升级渲染引擎后重建缓存'''
+
+import asyncio, logging, time, signal, multiprocessing, collections
+
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2, metrics
+
+from render_cache import RenderCache, cache_key
+
+class RenderError(Exception):
+    pass
+
+#默认配置，可通过configure()修改，workers为0时全部在当前线程渲染
+#cache_bytes为内存缓存的大小，cache_path为磁盘缓存的目录，为None时不使用磁盘缓存
+#block_cache_size为每个进程缓存的块数，为0时不按块缓存
+#budget为每篇文档的渲染时间上限(秒)，为None时不限制
+#engine为markdown2的渲染引擎，tokenizer不支持的文档自动改用regex，两者的输出相同，所以切换时不需要重建缓存
+_options = dict(workers=2, inline_size=16384, timeout=5.0, max_pending=32, cache_bytes=32 * 1024 * 1024, cache_path=None, cache_disk_bytes=256 * 1024 * 1024, block_cache_size=10000, budget=2.0, engine='regex')
+
+_executor = None
+
+cache = RenderCache(_options['cache_bytes'])
+
+#按块缓存，进程池中的子进程各有一份
+blocks = markdown2.BlockCache(_options['block_cache_size'])
+
+#已提交到进程池但尚未完成的任务数，任务超时后直到子进程实际完成才减少
+_pending = 0
+
+#进程池的空位，共max_pending个，在当前事件循环中首次使用时创建
+_slots = None
+
+def configure(**kw):
+    global _executor, _slots, cache, blocks
+    for k, v in kw.items():
+        if k not in _options:
+            raise ValueError('Invalid render option: %s' % k)
+        _options[k] = v
+    #进程数变化后重新创建进程池
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    _slots = None
+    cache = RenderCache(_options['cache_bytes'], _options['cache_path'], _options['cache_disk_bytes'])
+    blocks = markdown2.BlockCache(_options['block_cache_size'])
+
+#fork会复制父进程中持有的锁，如日志线程正持有的锁，子进程中再也无法释放
+#forkserver和spawn方式启动的子进程重新导入本模块，由_init_worker传入configure()设置的选项
+def _get_executor():
+    global _executor
+    if _executor is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _executor = ProcessPoolExecutor(max_workers=_options['workers'], mp_context=multiprocessing.get_context(method), initializer=_init_worker, initargs=(dict(_options),))
+    return _executor
+
+def _discard_executor(executor):
+    global _executor
+    if _executor is executor:
+        _executor = None
+    executor.shutdown(wait=False)
+
+def _init_worker(options):
+    global blocks
+    _options.update(options)
+    blocks = markdown2.BlockCache(_options['block_cache_size'])
+
+def _get_slots():
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(_options['max_pending'])
+    return _slots
+
+def _markdown(text, extras):
+    return markdown2.markdown(text, extras=extras, block_cache=blocks if _options['block_cache_size'] > 0 else None, time_budget=_options['budget'], engine=_options['engine'])
+
+def _interrupt(signum, frame):
+    raise markdown2.MarkdownTimeout('render interrupted after %s seconds' % _options['budget'])
+
+#markdown2只在各步骤之间检查时间预算，单个正则表达式的匹配无法中止
+#子进程中再用SIGALRM定时中断，正则表达式匹配的过程中也会响应信号
+@contextmanager
+def _time_limit(seconds):
+    if not seconds or not hasattr(signal, 'setitimer'):
+        yield
+        return
+    signal.signal(signal.SIGALRM, _interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+#在子进程中执行，返回(html, 是否退回为纯文本)，html为普通的str以便pickle
+def _convert(text, extras):
+    try:
+        with _time_limit(_options['budget']):
+            html = _markdown(text, extras)
+    except markdown2.MarkdownTimeout:
+        html = markdown2.fallback_html(text)
+    return str(html), html.fallback
+
+def _observe_fallback(text, fallback, route):
+    if fallback:
+        logging.warning('render %s chars exceeded the %ss budget or nested too deeply, fell back to plain text', len(text), _options['budget'])
+        metrics.MARKDOWN_RENDER_FALLBACKS.inc((route,))
+
+def _convert_inline(text, extras, route):
+    start = time.time()
+    html = _markdown(text, extras)
+    metrics.MARKDOWN_RENDER_TIME.observe(time.time() - start, (route,))
+    metrics.MARKDOWN_RENDERS.inc((route,))
+    _observe_fallback(text, html.fallback, route)
+    return html
+
+#退回为纯文本的结果不缓存，超出预算可能只是因为当时负载高，下次重新渲染
+def _store(key, html):
+    if not html.fallback:
+        cache.set(key, html)
+
+#将Markdown文本渲染为html，磁盘缓存的读写不阻塞事件循环
+@asyncio.coroutine
+def render(text, extras=None, timeout=None):
+    key = cache_key(text, extras)
+    html = yield from cache.get_async(key)
+    if html is not None:
+        metrics.MARKDOWN_RENDERS.inc(('cache',))
+    else:
+        html = yield from _render(text, extras, timeout)
+        if not html.fallback:
+            cache.set_async(key, html)
+    return html
+
+@asyncio.coroutine
+def _render(text, extras, timeout):
+    if _options['workers'] <= 0 or len(text) < _options['inline_size']:
+        return _convert_inline(text, extras, 'inline')
+    timeout = timeout or _options['timeout']
+    start = time.time()
+    slots = _get_slots()
+    #没有空位时等待，不在事件循环中渲染大文档
+    try:
+        yield from asyncio.wait_for(slots.acquire(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning('render queue full (%s pending), reject %s chars', _pending, len(text))
+        metrics.MARKDOWN_RENDERS.inc(('overflow',))
+        raise RenderError('render queue full, %s chars not rendered' % len(text))
+    executor = _get_executor()
+    #进程池已损坏或已关闭时submit抛出RuntimeError(BrokenProcessPool也是RuntimeError)
+    try:
+        fut = asyncio.get_event_loop().run_in_executor(executor, _convert, text, extras)
+    except RuntimeError as e:
+        slots.release()
+        _discard_executor(executor)
+        raise RenderError('render pool unavailable: %s' % e)
+    except Exception:
+        slots.release()
+        raise
+    _task_started()
+    fut.add_done_callback(lambda f: _task_done(f, slots))
+    #超时后子进程仍在渲染，shield使wait_for不取消fut，空位在fut完成时才释放
+    try:
+        html, fallback = yield from asyncio.wait_for(asyncio.shield(fut), max(timeout - (time.time() - start), 0))
+    except asyncio.TimeoutError:
+        metrics.MARKDOWN_RENDERS.inc(('timeout',))
+        raise RenderError('render %s chars timeout' % len(text))
+    except BrokenProcessPool as e:
+        #子进程被杀死(如OOM)后进程池不能再用，丢弃它，下次渲染时重新创建
+        logging.error('render pool broken: %s', e)
+        _discard_executor(executor)
+        raise RenderError('render pool broken, %s chars not rendered' % len(text))
+    metrics.MARKDOWN_RENDER_TIME.observe(time.time() - start, ('process',))
+    metrics.MARKDOWN_RENDERS.inc(('process',))
+    _observe_fallback(text, fallback, 'process')
+    html = markdown2.UnicodeWithAttrs(html)
+    html.fallback = fallback
+    return html
+
+def _task_started():
+    global _pending
+    _pending += 1
+    metrics.MARKDOWN_RENDER_PENDING.set(_pending)
+
+#子进程完成后释放空位，超时后无人等待的结果在这里取出异常，避免asyncio报告未取出的异常
+def _task_done(fut, slots):
+    global _pending
+    _pending -= 1
+    metrics.MARKDOWN_RENDER_PENDING.set(_pending)
+    slots.release()
+    if not fut.cancelled():
+        fut.exception()
+
+#重新渲染大量文本并写入缓存，如升级渲染引擎后重建整个博客的缓存，已缓存的文本跳过
+#由markdown2.markdown_many分给processes个进程并行渲染，为None时每个CPU核一个进程，所有文本共用一个进程池
+#texts可以是生成器，边读取边渲染，内存中只有正在渲染的文本
+#调用期间阻塞当前线程，协程中应通过run_in_executor在线程池中调用
+#返回实际渲染的文本数
+def rebuild(texts, extras=None, processes=None, chunksize=8):
+    #todo()可能在进程池的任务线程中执行，按顺序记下交给进程池的文本，与按顺序返回的结果一一对应
+    submitted, seen = collections.deque(), set()
+    def todo():
+        for text in texts:
+            key = cache_key(text, extras)
+            if key in seen or cache.get(key) is not None:
+                continue
+            seen.add(key)
+            submitted.append((key, text))
+            yield text
+    rendered = 0
+    for html in markdown2.markdown_many(todo(), extras=extras, time_budget=_options['budget'], processes=processes, chunksize=chunksize, engine=_options['engine']):
+        key, text = submitted.popleft()
+        metrics.MARKDOWN_RENDERS.inc(('batch',))
+        _observe_fallback(text, html.fallback, 'batch')
+        _store(key, html)
+        rendered += 1
+    return rendered
+
+#批量渲染，供后台任务使用，返回与texts一一对应的html，渲染失败的位置为异常对象，如RenderError
+@asyncio.coroutine
+def render_many(texts, extras=None, timeout=None):
+    return (yield from asyncio.gather(*[render(t, extras, timeout) for t in texts], return_exceptions=True))
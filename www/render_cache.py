@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Markdown渲染结果缓存，按内容寻址
+
+key为(渲染引擎版本, extras, safe_mode, 文本)的SHA1，内容相同的文本只渲染一次，如撤销的修改、重复导入
+内存中为LRU缓存，按UTF-8编码后的字节数计算大小，超出max_bytes时淘汰最久未使用的结果
+设置了path时还会写入磁盘，多个worker进程共享，磁盘上的总大小超出disk_max_bytes时删除最早写入的文件
+事件循环中使用get_async()和set_async()，磁盘读写和清理在线程池中执行'''
+
+import hashlib, os, threading, tempfile, logging, asyncio
+
+from collections import OrderedDict
+
+import markdown2, metrics
+
+#渲染结果与markdown2的版本有关，升级或修改渲染逻辑后改变此值，旧的缓存自动失效
+ENGINE_VERSION = 'markdown2-%s/2' % markdown2.__version__
+
+def _extras_key(extras):
+    if not extras:
+        return ''
+    if isinstance(extras, dict):
+        return repr(sorted(extras.items()))
+    return repr(sorted(extras))
+
+def cache_key(text, extras=None, safe_mode=None):
+    '''
+    >>> cache_key('# a') == cache_key('# a', [])
+    True
+    >>> cache_key('# a', ['toc', 'footnotes']) == cache_key('# a', ['footnotes', 'toc'])
+    True
+    >>> cache_key('# a') == cache_key('# a', safe_mode='escape')
+    False
+    '''
+    h = hashlib.sha1()
+    h.update(('%s\0%s\0%s\0' % (ENGINE_VERSION, _extras_key(extras), safe_mode)).encode('utf-8'))
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+#缓存中保存普通的str，取出时转换为与markdown2.markdown()相同的返回类型，缓存的结果都不是退回的纯文本
+def _html(text):
+    html = markdown2.UnicodeWithAttrs(text)
+    html.fallback = False
+    return html
+
+class RenderCache(object):
+
+    #每写入多少次检查一次磁盘上的总大小
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, path=None, disk_max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.disk_max_bytes = disk_max_bytes
+        self.bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._pruning = False
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    #在当前线程读取磁盘，供rebuild等不在事件循环中的调用
+    def get(self, key):
+        html = self._get_memory(key)
+        if html is None:
+            html = self._got_disk(key, self._read(key))
+        return html
+
+    @asyncio.coroutine
+    def get_async(self, key):
+        html = self._get_memory(key)
+        if html is None:
+            text = None
+            if self.path:
+                text = yield from asyncio.get_event_loop().run_in_executor(None, self._read, key)
+            html = self._got_disk(key, text)
+        return html
+
+    def set(self, key, html):
+        html = str(html)
+        self._put(key, html)
+        if self.path:
+            self._write(key, html)
+
+    #写入内存后立即返回，磁盘写入在线程池中执行，不等待完成
+    def set_async(self, key, html):
+        html = str(html)
+        self._put(key, html)
+        if self.path:
+            asyncio.get_event_loop().run_in_executor(None, self._write, key, html)
+
+    def _get_memory(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            self.memory_hits += 1
+        metrics.RENDER_CACHE_LOOKUPS.inc(('memory',))
+        return _html(item[0])
+
+    def _got_disk(self, key, text):
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+        if text is None:
+            metrics.RENDER_CACHE_LOOKUPS.inc(('miss',))
+            return None
+        metrics.RENDER_CACHE_LOOKUPS.inc(('disk',))
+        self._put(key, text)
+        return _html(text)
+
+    #放入内存，_data中保存(html, 字节数)
+    def _put(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (html, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (evicted, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.html')
+
+    def _read(self, key):
+        if not self.path:
+            return None
+        try:
+            with open(self._file(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    #先写入临时文件再改名，其他进程不会读到写了一半的文件
+    def _write(self, key, html):
+        filename = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(html)
+            os.replace(tmp, filename)
+        except (IOError, OSError) as e:
+            logging.warning('write render cache %s failed: %s', filename, e)
+            return
+        with self._lock:
+            self._writes += 1
+            #同一时间只有一个线程清理
+            prune = self._writes % self.PRUNE_INTERVAL == 0 and not self._pruning
+            if prune:
+                self._pruning = True
+        if prune:
+            try:
+                self.prune()
+            finally:
+                self._pruning = False
+
+    #磁盘上的总大小超出disk_max_bytes时，从最早写入的文件开始删除
+    def prune(self):
+        if not self.path:
+            return 0
+        files, total = [], 0
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith('.html'):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+        removed = 0
+        for mtime, size, filename in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), bytes=self.bytes, memory_hits=self.memory_hits, disk_hits=self.disk_hits, misses=self.misses)
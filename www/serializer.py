@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''API响应的JSON序列化，直接编码为UTF-8的bytes
+
+可用的后端：
+orjson，C实现，安装了orjson时自动使用
+json，标准库，作为后备
+也可通过register_backend()注册其他后端，再用use()切换'''
+
+import json, logging
+
+from orm import Model
+
+#屏蔽字段序列化后的值
+MASK = '******'
+
+#按Model类缓存的编码函数
+_model_encoders = {}
+
+#根据Model类的__mappings__生成编码函数，将实例转换为普通dict，并屏蔽标记为masked的字段
+def model_encoder(cls):
+    encoder = _model_encoders.get(cls)
+    if encoder is not None:
+        return encoder
+    masked = tuple(cls.__masked_fields__)
+    if masked:
+        def encoder(obj):
+            d = dict(obj)
+            for k in masked:
+                if k in d:
+                    d[k] = MASK
+            return d
+    else:
+        encoder = dict
+    _model_encoders[cls] = encoder
+    return encoder
+
+#标准库后端不会对dict的子类调用default，需先把Model实例转换掉
+def _prepare(obj):
+    if isinstance(obj, Model):
+        return model_encoder(obj.__class__)(obj)
+    if isinstance(obj, dict):
+        return dict((k, _prepare(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_prepare(v) for v in obj]
+    return obj
+
+def _json_dumps(obj):
+    return json.dumps(_prepare(obj), ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+def _orjson_backend():
+    import orjson
+    #OPT_PASSTHROUGH_SUBCLASS使dict, str等的子类也交给default处理，Model实例在此被转换并屏蔽字段
+    option = orjson.OPT_PASSTHROUGH_SUBCLASS | orjson.OPT_NON_STR_KEYS
+
+    def default(o):
+        if isinstance(o, Model):
+            return model_encoder(o.__class__)(o)
+        if isinstance(o, dict):
+            return dict(o)
+        if isinstance(o, str):
+            return str(o)
+        if isinstance(o, int):
+            return int(o)
+        if isinstance(o, (list, tuple)):
+            return list(o)
+        #其他对象，如apis.Page，按其属性序列化
+        if hasattr(o, '__dict__'):
+            return o.__dict__
+        raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=option)
+    return dumps
+
+_backends = {
+    'json': _json_dumps
+}
+
+#注册后端，dumps接收对象，返回UTF-8编码的bytes
+def register_backend(name, dumps):
+    _backends[name] = dumps
+
+try:
+    register_backend('orjson', _orjson_backend())
+except ImportError:
+    pass
+
+_backend = None
+_dumps = _json_dumps
+
+#切换后端，'auto'表示优先使用orjson
+def use(name='auto'):
+    global _backend, _dumps
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in _backends else 'json'
+    if name not in _backends:
+        raise ValueError('Unknown JSON backend: %s' % name)
+    _backend, _dumps = name, _backends[name]
+    logging.info('use JSON backend: %s' % name)
+
+def backend():
+    return _backend
+
+#将对象序列化为UTF-8编码的JSON
+def dumps(obj):
+    return _dumps(obj)
+
+#在html中内嵌JSON时需要转义的字符，避免出现</script>或被当作html解析
+_HTML_ESCAPES = (('&', '\\u0026'), ('<', '\\u003c'), ('>', '\\u003e'), ("'", '\\u0027'))
+
+#序列化为可以直接写入<script>中的JSON字符串
+def dumps_html(obj):
+    '''
+    >>> print(dumps_html("</script><b>&'"))
+    "\\u003c/script\\u003e\\u003cb\\u003e\\u0026\\u0027"
+    '''
+    s = dumps(obj).decode('utf-8')
+    for c, e in _HTML_ESCAPES:
+        s = s.replace(c, e)
+    return s
+
+#流式JSON响应，URL处理函数返回此对象时，结果以分块传输的方式逐批编码、发送
+#source需提供fetch()协程，每次返回一批对象，返回空列表表示结束，以及close()方法，如orm.ModelStream
+#ndjson为True时每行一个JSON对象，否则输出一个JSON数组
+class JSONStream(object):
+
+    def __init__(self, source, ndjson=False):
+        self.source = source
+        self.ndjson = ndjson
+        if ndjson:
+            self.content_type = 'application/x-ndjson'
+            self.head, self.tail = b'', b''
+        else:
+            self.content_type = 'application/json'
+            self.head, self.tail = b'[', b']'
+
+    #将一批对象编码为响应的一块，first表示是否为第一块
+    def encode(self, batch, first):
+        if self.ndjson:
+            return b''.join([dumps(obj) + b'\n' for obj in batch])
+        #整批作为数组编码后去掉两端的[]，比逐个编码快
+        chunk = dumps(batch)[1:-1]
+        return chunk if first else b',' + chunk
+
+use()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''markdown2的测试：按块增量渲染、tokenizer引擎的结果必须与整篇用regex引擎渲染完全相同
+两种引擎对基准测试语料和CASES的输出必须与test_markdown2_golden.json.gz中保存的逐字节相同
+golden中的结果由改用占位符(user-048)之前的渲染引擎生成，修改渲染逻辑时不应改变任何输出
+用法：python3 test_markdown2.py [次数]，或者用pytest运行'''
+
+import os, sys, random, gzip, json
+
+import markdown2, bench_markdown_suite
+
+#已知曾经出错的输入，每次都测试
+CASES = [
+    #高亮的代码块生成<div>，后面多出的</div>把中间的块都并入了这个html块
+    '```\nfenced\n\nblank\n```\n\n```python\nx=1\n```\n\n## H2\n\n&amp; < > "q"\n\n</div>',
+    #空的列表项把下一段并入列表
+    '- \n\nnext paragraph\n\n- a\n- b\n',
+    #多出的结束标签与前面生成的<ul>、<pre>配对
+    '- a\n- b\n\n&amp; <\n\n</ul>\n',
+    '    code\n\nx<\n\n</pre>\n',
+]
+
+FRAGMENTS = ['# 标题', '## H2 *em*', '段落 **strong** `code` [link](http://a.b/c_d "t")', 'a < b & c > d',
+             '- a\n- b', '1. x\n2. y', '- ', '    code\n    more', '> quote\n> more', '---',
+             '```\nfenced\n\nblank\n```', '```python\nx = 1\n```', '<div>\nhtml\n</div>', '</div>', '<!-- c -->',
+             'text [^1]', '[^1]: note', '[ref]: http://r/ "R"', '[r][ref] _u_', 'line  \nbreak', '&amp; "q"']
+
+EXTRAS = [None, ['fenced-code-blocks'], ['footnotes', 'header-ids'], ['fenced-code-blocks', 'toc', 'nofollow', 'code-friendly']]
+
+def random_doc(r):
+    return '\n\n'.join(r.choice(FRAGMENTS) for _ in range(r.randint(1, 12)))
+
+#整篇渲染与增量渲染比较，同一个缓存再渲染一份修改过的文档，检查命中缓存的块
+def check(text, extras):
+    cache = markdown2.BlockCache()
+    edited = text.replace('\n\n', '\n\n改动\n\n', 1)
+    for t in (text, edited, text):
+        full = markdown2.Markdown(extras=extras).convert(t)
+        incremental = markdown2.Markdown(extras=extras).convert(t, cache)
+        assert incremental == full, 'extras=%r text=%r' % (extras, t)
+
+#tokenizer引擎与regex引擎比较
+def check_tokenizer(text, extras):
+    expected = markdown2.Markdown(extras=extras).convert(text)
+    assert markdown2.TokenizerMarkdown(extras=extras).convert(text) == expected, 'extras=%r text=%r' % (extras, text)
+
+def test_cases():
+    for text in CASES:
+        for extras in EXTRAS:
+            check(text, extras)
+            check_tokenizer(text, extras)
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_markdown2_golden.json.gz')
+
+#golden中的每一项：(名称, 文本, extras)，名称为'文档|extras名'
+def golden_docs():
+    docs = [('corpus:%s' % n, t) for n, t in bench_markdown_suite.corpus()] + [('case:%s' % i, t) for i, t in enumerate(CASES)]
+    for name, text in docs:
+        for ename, extras in bench_markdown_suite.EXTRAS:
+            yield '%s|%s' % (name, ename), text, extras
+
+def _pygments_version():
+    try:
+        import pygments
+    except ImportError:
+        return None
+    return pygments.__version__
+
+def test_golden():
+    with gzip.open(GOLDEN, 'rt', encoding='utf-8') as f:
+        golden = json.load(f)
+    same_pygments = golden['pygments'] == _pygments_version()
+    checked = 0
+    for name, text, extras in golden_docs():
+        expected = golden['html'].get(name)
+        #新加入CASES的文本没有golden，代码高亮的输出随Pygments版本变化
+        if expected is None or ('class="codehilite"' in expected and not same_pygments):
+            continue
+        for engine in (markdown2.Markdown, markdown2.TokenizerMarkdown):
+            assert engine(extras=extras).convert(text) == expected, '%s %s' % (engine.__name__, name)
+        checked += 1
+    assert checked > 0
+
+def test_incremental_random(n=300, seed=2016):
+    r = random.Random(seed)
+    for _ in range(n):
+        check(random_doc(r), r.choice(EXTRAS))
+
+def test_tokenizer_random(n=300, seed=2016):
+    r = random.Random(seed)
+    for _ in range(n):
+        check_tokenizer(random_doc(r), r.choice(EXTRAS))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    test_cases()
+    test_golden()
+    test_incremental_random(n)
+    test_tokenizer_random(n)
+    print('ok')